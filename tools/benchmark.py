@@ -0,0 +1,318 @@
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import mercantile
+import numpy as np
+
+from mbtiles_utils import create_deduplicated_schema, insert_tiles, write_metadata
+from terrain_codec import encode_tile
+
+# Synthetic datasets are centered here so the HGT conversion produces whole 1x1 degree cells
+CENTER_LON, CENTER_LAT = 10.5, 47.5
+
+
+def synthetic_elevations(tile: mercantile.Tile, size: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    """Smooth, position-dependent terrain so neighbouring tiles and zoom levels agree."""
+    bounds = mercantile.bounds(tile)
+    lon = np.linspace(bounds.west, bounds.east, size)
+    lat = np.linspace(bounds.north, bounds.south, size)
+    lon_grid, lat_grid = np.meshgrid(lon, lat)
+    elevations = 1500.0 + 1200.0 * np.sin(lon_grid * 3.1) * np.cos(lat_grid * 2.3) + 300.0 * np.sin(lon_grid * 17.0 + lat_grid * 11.0)
+    if noise:
+        elevations += rng.normal(0.0, noise, elevations.shape)
+    return elevations
+
+
+def source_tiles(index: int, tiles: int, min_zoom: int, max_zoom: int, overlap: float):
+    """Yields the (z, x, y) XYZ tiles of synthetic source `index`.
+
+    Every source covers a square of about `tiles` tiles at max_zoom (plus its
+    parents at lower zooms). Each source is shifted east of the previous one so
+    that consecutive sources share `overlap` of their width.
+    """
+    side = max(1, int(math.isqrt(tiles)))
+    center = mercantile.tile(CENTER_LON, CENTER_LAT, max_zoom)
+    shift = int(round(side * (1.0 - overlap)))
+    x0 = center.x - side // 2 + index * shift
+    y0 = center.y - side // 2
+    for z in range(min_zoom, max_zoom + 1):
+        level_shift = max_zoom - z
+        for x in range(x0 >> level_shift, ((x0 + side - 1) >> level_shift) + 1):
+            for y in range(y0 >> level_shift, ((y0 + side - 1) >> level_shift) + 1):
+                yield mercantile.Tile(x, y, z)
+
+
+def generate_source(path: str, index: int, params: dict) -> dict:
+    """Writes one synthetic deduplicated MBTiles source.
+
+    A `duplicate_fraction` of the tiles are flat sea-level tiles, which share a
+    single tiles_data row like real coastlines and oceans do.
+    """
+    rng = np.random.default_rng(params["seed"] + index)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    create_deduplicated_schema(cur)
+
+    flat = None
+    rows = []
+    count = 0
+    for tile in source_tiles(index, params["tiles"], params["min_zoom"], params["max_zoom"], params["overlap"]):
+        if rng.random() < params["duplicate_fraction"]:
+            if flat is None:
+                flat = encode_tile(np.zeros((params["tile_size"], params["tile_size"])), params["encoding"], params["format"])
+            data = flat
+        else:
+            elevations = synthetic_elevations(tile, params["tile_size"], params["noise"], rng)
+            data = encode_tile(elevations, params["encoding"], params["format"])
+        rows.append((tile.z, tile.x, (2 ** tile.z) - tile.y - 1, data))
+        count += 1
+        if len(rows) >= 500:
+            insert_tiles(cur, rows)
+            rows = []
+    insert_tiles(cur, rows)
+
+    write_metadata(cur, {
+        "name": f"synthetic_{index}",
+        "format": params["format"],
+        "minzoom": params["min_zoom"],
+        "maxzoom": params["max_zoom"],
+        "encoding": params["encoding"],
+    })
+    conn.commit()
+    (blob_bytes, unique_blobs) = cur.execute("SELECT SUM(LENGTH(tile_data)), COUNT(*) FROM tiles_data").fetchone()
+    conn.close()
+    return {"path": path, "tiles": count, "unique_blobs": unique_blobs, "blob_bytes": blob_bytes, "file_bytes": os.path.getsize(path)}
+
+
+def dir_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def run_case(case: dict) -> dict:
+    """Runs one benchmark case in the current process (called in a fresh child by measure_case)."""
+    start = time.perf_counter()
+    if case["name"] == "merge_mbtiles":
+        from combine import merge_mbtiles
+        if os.path.exists(case["output"]):
+            os.remove(case["output"])
+        merge_mbtiles(case["output"], case["sources"])
+    elif case["name"] == "convert_mbtiles_to_hgt_flexible":
+        from mbtiles_to_hgt import convert_mbtiles_to_hgt_flexible
+        from rasterio.enums import Resampling
+        os.makedirs(case["output"], exist_ok=True)
+        for f in os.listdir(case["output"]):
+            os.remove(os.path.join(case["output"], f))
+        convert_mbtiles_to_hgt_flexible(
+            case["sources"][0], case["output"], zoom_level=case["zoom"], encoding=case["encoding"],
+            resampling_method=Resampling[case["resampling"]],
+        )
+    else:
+        raise ValueError(f"Unknown benchmark case {case['name']}")
+    seconds = time.perf_counter() - start
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "seconds": seconds,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": self_usage.ru_maxrss,
+        "peak_children_rss_kb": children_usage.ru_maxrss,
+        "output_bytes": dir_size(case["output"]),
+    }
+
+
+def measure_case(case: dict) -> dict:
+    """Runs a case in a new interpreter so peak RSS is not polluted by earlier cases."""
+    with tempfile.NamedTemporaryFile("r", suffix=".json", delete=False) as f:
+        result_path = f.name
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_run", json.dumps(case), result_path],
+                check=True, stdout=None if case.get("verbose") else devnull,
+            )
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+
+def run_benchmarks(work_dir: str, params: dict, repeat: int = 3, cases=None, verbose: bool = False) -> dict:
+    """Generates synthetic sources and times merge_mbtiles and convert_mbtiles_to_hgt_flexible.
+
+    Args:
+        work_dir (str): Directory for the synthetic inputs and outputs.
+        params (dict): Generator parameters (sources, tiles, zooms, overlap, tile size, noise, ...).
+        repeat (int): Runs per case; every run is recorded and the fastest is reported as "best".
+        cases (list[str]): Subset of cases to run (default: all).
+
+    Returns:
+        dict: JSON-serializable results.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    print(f"Generating {params['sources']} synthetic sources in {work_dir}...")
+    sources = []
+    for i in range(params["sources"]):
+        info = generate_source(os.path.join(work_dir, f"synthetic_{i}.mbtiles"), i, params)
+        print(f"  {info['path']}: {info['tiles']} tiles, {info['unique_blobs']} unique blobs, {info['file_bytes']} bytes")
+        sources.append(info)
+
+    source_paths = [s["path"] for s in sources]
+    total_tiles = sum(s["tiles"] for s in sources)
+    all_cases = {
+        "merge_mbtiles": {
+            "name": "merge_mbtiles",
+            "sources": source_paths,
+            "output": os.path.join(work_dir, "merged.mbtiles"),
+            "input_tiles": total_tiles,
+        },
+        "convert_mbtiles_to_hgt_flexible": {
+            "name": "convert_mbtiles_to_hgt_flexible",
+            "sources": source_paths[:1],
+            "output": os.path.join(work_dir, "hgt"),
+            "zoom": params["max_zoom"],
+            "encoding": params["encoding"],
+            "resampling": params["resampling"],
+            "input_tiles": sum(1 for t in source_tiles(0, params["tiles"], params["max_zoom"], params["max_zoom"], params["overlap"])),
+        },
+    }
+
+    results = []
+    for name in cases or all_cases:
+        case = dict(all_cases[name], verbose=verbose)
+        runs = []
+        for run in range(repeat):
+            runs.append(measure_case(case))
+            print(f"  {name} run {run + 1}/{repeat}: {runs[-1]['seconds']:.3f}s")
+        best = min(runs, key=lambda r: r["seconds"])
+        results.append({
+            "name": name,
+            "input_tiles": case["input_tiles"],
+            "runs": runs,
+            "best_seconds": best["seconds"],
+            "median_seconds": statistics.median(r["seconds"] for r in runs),
+            "tiles_per_second": case["input_tiles"] / best["seconds"] if best["seconds"] else None,
+            "peak_rss_kb": max(r["peak_rss_kb"] for r in runs),
+            "peak_children_rss_kb": max(r["peak_children_rss_kb"] for r in runs),
+            "output_bytes": best["output_bytes"],
+        })
+
+    return {
+        "system": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "params": params,
+        "sources": sources,
+        "results": results,
+    }
+
+
+def params_differences(params: dict, baseline_params: dict) -> list:
+    """Lists the benchmark parameters that differ from the baseline run as "name: old -> new"."""
+    return [
+        f"{name}: {baseline_params.get(name)} -> {params.get(name)}"
+        for name in sorted(set(params) | set(baseline_params))
+        if params.get(name) != baseline_params.get(name)
+    ]
+
+
+def print_results(report: dict, baseline: dict = None):
+    if baseline and params_differences(report["params"], baseline.get("params", {})):
+        # Ratios between runs on different synthetic data are meaningless
+        print("Baseline was run with different parameters, not comparing.")
+        baseline = None
+    previous = {r["name"]: r for r in baseline["results"]} if baseline else {}
+    print(f"{'case':<34} {'best s':>9} {'tiles/s':>10} {'rss MB':>8} {'child MB':>9} {'out MB':>8} {'vs base':>8}")
+    for r in report["results"]:
+        change = ""
+        if r["name"] in previous and previous[r["name"]]["best_seconds"]:
+            change = f"{r['best_seconds'] / previous[r['name']]['best_seconds']:.2f}x"
+        print(
+            f"{r['name']:<34} {r['best_seconds']:>9.3f} {r['tiles_per_second'] or 0:>10.1f} "
+            f"{r['peak_rss_kb'] / 1024:>8.1f} {r['peak_children_rss_kb'] / 1024:>9.1f} "
+            f"{r['output_bytes'] / 1048576:>8.2f} {change:>8}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "_run":
+        # Child process started by measure_case
+        result = run_case(json.loads(sys.argv[2]))
+        with open(sys.argv[3], "w") as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark combine.py and mbtiles_to_hgt.py on synthetic MBTiles.")
+    parser.add_argument("-w", "--work-dir", default=None, help="Directory for synthetic data (default: a temporary directory).")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="Where to write the JSON results.")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON to compare against.")
+    parser.add_argument("--sources", type=int, default=3, help="Number of synthetic sources.")
+    parser.add_argument("--tiles", type=int, default=256, help="Tiles per source at max zoom.")
+    parser.add_argument("--min-zoom", type=int, default=0, help="Lowest zoom level generated.")
+    parser.add_argument("--max-zoom", type=int, default=12, help="Highest zoom level generated.")
+    parser.add_argument("--overlap", type=float, default=0.5, help="Fraction of its width each source shares with the previous one.")
+    parser.add_argument("--tile-size", type=int, default=256, help="Tile width/height in pixels.")
+    parser.add_argument("--noise", type=float, default=2.0, help="Elevation noise in meters (larger values give larger blobs).")
+    parser.add_argument("--duplicate-fraction", type=float, default=0.1, help="Fraction of tiles that are identical flat tiles.")
+    parser.add_argument("-e", "--encoding", choices=['terrarium', 'mapbox'], default='mapbox', help="Encoding")
+    parser.add_argument("--format", default='webp', choices=['png', 'webp'], help="Tile format.")
+    parser.add_argument("--resampling", default='bilinear', choices=['nearest', 'bilinear', 'cubic', 'average'], help="Resampling for the HGT conversion.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case.")
+    parser.add_argument("--case", nargs='+', choices=['merge_mbtiles', 'convert_mbtiles_to_hgt_flexible'], default=None, help="Only run these cases.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the output of the benchmarked functions.")
+    args = parser.parse_args()
+
+    params = {
+        "sources": args.sources,
+        "tiles": args.tiles,
+        "min_zoom": args.min_zoom,
+        "max_zoom": args.max_zoom,
+        "overlap": args.overlap,
+        "tile_size": args.tile_size,
+        "noise": args.noise,
+        "duplicate_fraction": args.duplicate_fraction,
+        "encoding": args.encoding,
+        "format": args.format,
+        "resampling": args.resampling,
+        "seed": args.seed,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Refuse before running anything, ratios are only meaningful on the same data
+        differences = params_differences(params, baseline.get("params", {}))
+        if differences:
+            raise SystemExit(
+                f"Error: {args.baseline} was run with different parameters:\n  " + "\n  ".join(differences)
+            )
+
+    if args.work_dir:
+        report = run_benchmarks(args.work_dir, params, args.repeat, args.case, args.verbose)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = run_benchmarks(work_dir, params, args.repeat, args.case, args.verbose)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print_results(report, baseline)
+    print(f"Results written to: {args.output}")
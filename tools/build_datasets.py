@@ -0,0 +1,463 @@
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+
+
+STATE_FILE = ".build_state.json"
+
+# Datasets may share an output directory (e.g. TerrainRGB and Terrarium builds
+# of the same source), so state updates are serialized. Stages they have in
+# common (e.g. the same VRT) are shared and run once, see build_all.
+_state_lock = threading.Lock()
+
+
+class ThreadBudget:
+    """A global pool of worker threads shared by every dataset being built.
+
+    Stages ask for a number of threads and block until that many are free, so
+    several datasets can run side by side without oversubscribing the machine.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self.free = self.total
+        self.cond = threading.Condition()
+
+    def acquire(self, wanted: int) -> int:
+        wanted = max(1, min(wanted, self.total))
+        with self.cond:
+            while self.free < wanted:
+                self.cond.wait()
+            self.free -= wanted
+        return wanted
+
+    def release(self, count: int):
+        with self.cond:
+            self.free += count
+            self.cond.notify_all()
+
+
+class Stage:
+    """One step of a dataset build (assign SRS, build VRT, warp, tile, metadata).
+
+    Args:
+        name (str): Stage name, unique within the dataset.
+        output (str): Path of the file the stage produces.
+        params (dict): Parameters that affect the output (part of the fingerprint).
+        run: Callable taking the number of granted threads and producing the output.
+        deps (list[Stage]): Upstream stages whose fingerprints feed into this one.
+        input_files (list[str]): Files read by the stage that are not produced by a dep.
+        threads (int): Threads to request from the global budget while running.
+    """
+
+    def __init__(self, name, output, params, run, deps=None, input_files=None, threads=1):
+        self.name = name
+        self.output = output
+        self.params = params
+        self.run = run
+        self.deps = deps or []
+        self.input_files = input_files or []
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.ran = False
+        self._fingerprint = None
+
+    def same_as(self, other) -> bool:
+        """True if other produces the same output from the same parameters, inputs and deps."""
+        return (
+            self.name == other.name
+            and self.output == other.output
+            and self.params == other.params
+            and self.input_files == other.input_files
+            and self.deps == other.deps
+        )
+
+    @property
+    def key(self) -> str:
+        return f"{os.path.basename(self.output)}#{self.name}"
+
+    def fingerprint(self) -> str:
+        """Hash of the stage parameters, its input files and its deps' fingerprints."""
+        if self._fingerprint is None:
+            inputs = []
+            for path in sorted(self.input_files):
+                st = os.stat(path)
+                inputs.append([path, st.st_size, st.st_mtime_ns])
+            payload = {
+                "stage": self.name,
+                "params": self.params,
+                "inputs": inputs,
+                "deps": [dep.fingerprint() for dep in self.deps],
+            }
+            digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8"))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+
+def load_state(output_dir: str) -> dict:
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable build state {path}: {e}")
+        return {}
+
+
+def record_state(output_dir: str, key: str, fingerprint: str = None):
+    """Stores (or clears, if fingerprint is None) the fingerprint of a finished stage."""
+    with _state_lock:
+        state = load_state(output_dir)
+        if fingerprint is None:
+            state.pop(key, None)
+        else:
+            state[key] = fingerprint
+        path = os.path.join(output_dir, STATE_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
+def params_tag(params: dict) -> str:
+    """Short hash of stage parameters, so intermediate files of differently configured builds never collide."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+
+
+def run_command(cmd: list[str], cwd: str):
+    print(f"  $ {' '.join(cmd)}")
+    subprocess.run(cmd, cwd=cwd, check=True)
+
+
+def set_metadata(mbtiles_path: str, metadata: dict):
+    """Replaces the given metadata entries (replaces the sqlite3 calls at the end of create_*.sh)."""
+    conn = sqlite3.connect(mbtiles_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index on tiles (zoom_level, tile_column, tile_row);")
+        for name, value in metadata.items():
+            cur.execute("DELETE FROM metadata WHERE name = ?", (name,))
+            cur.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (name, str(value)))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def build_stages(dataset: dict, base_dir: str) -> list[Stage]:
+    """Describes a dataset's create_*.sh pipeline as a chain of stages.
+
+    The VRT and warp outputs are named without the zoom range or tile format, so
+    changing MAXZOOM or FORMAT only re-runs the tiling and metadata stages. They
+    carry a short hash of their own parameters instead, so datasets sharing an
+    output directory (e.g. TerrainRGB and Terrarium builds with different
+    nodata values) get separate intermediate files.
+
+    Args:
+        dataset (dict): One entry of the config "datasets" list.
+        base_dir (str): Directory relative paths in the config are resolved against.
+
+    Returns:
+        list[Stage]: Stages in dependency order.
+    """
+    workdir = os.path.normpath(os.path.join(base_dir, dataset.get("workdir", dataset["name"])))
+    output_dir = os.path.join(workdir, dataset.get("output_dir", "output"))
+    basename = dataset.get("basename", dataset["name"])
+    resampling = dataset.get("resampling", "cubic")
+
+    vrt_opts = dataset.get("vrt", {})
+    warp_opts = dataset.get("warp", {})
+    tile_opts = dataset.get("tile", {})
+
+    input_files = sorted(glob.glob(os.path.join(workdir, dataset["input"])))
+    if not input_files:
+        raise ValueError(f"{dataset['name']}: no input files match {dataset['input']!r}")
+
+    cutline = warp_opts.get("cutline")
+    if cutline:
+        cutline = os.path.join(workdir, cutline)
+
+    stages = []
+    assign_srs = dataset.get("assign_srs")
+    if assign_srs:
+        srs_params = {"srs": assign_srs, "files": [os.path.basename(path) for path in input_files]}
+        marker = os.path.join(output_dir, f".{basename}_{params_tag(srs_params)}.srs")
+
+        def run_srs(threads):
+            # Same check as create_terrainrgb.sh: a few input files ship without a CRS
+            fixed = []
+            for path in input_files:
+                info = subprocess.run(["gdalinfo", path], cwd=workdir, check=True, capture_output=True, text=True)
+                if "coordinate system" not in info.stdout.lower():
+                    print(f"  Setting CRS for: {path}")
+                    run_command(["gdal_edit.py", "-a_srs", assign_srs, path], workdir)
+                    fixed.append(path)
+            with open(marker, "w") as f:
+                json.dump(fixed, f, indent=2)
+
+        # Not a dep of the VRT stage: fixing a file changes its mtime, which the
+        # VRT fingerprint already picks up, as it is computed after this stage ran.
+        stages.append(Stage("srs", marker, srs_params, run_srs))
+
+    vrt_params = {"resampling": resampling, "input": dataset["input"], **vrt_opts}
+    warp_params = {"resampling": resampling, **warp_opts}
+    vrt_tag = params_tag(vrt_params)
+    warp_tag = params_tag({"vrt": vrt_tag, **warp_params})
+    vrtfile = os.path.join(output_dir, f"{basename}_{resampling}_{vrt_tag}.vrt")
+    vrtfile2 = os.path.join(output_dir, f"{basename}_{resampling}_{warp_tag}_warp.vrt")
+
+    def run_vrt(threads):
+        cmd = ["gdalbuildvrt", "-overwrite", "-resolution", vrt_opts.get("resolution", "highest"), "-r", resampling]
+        if "srcnodata" in vrt_opts:
+            cmd += ["-srcnodata", str(vrt_opts["srcnodata"])]
+        if "vrtnodata" in vrt_opts:
+            cmd += ["-vrtnodata", str(vrt_opts["vrtnodata"])]
+        # Large datasets (JAXA has ~24k tiles) overflow the argv limit, which the
+        # shell scripts avoided with ulimit -s; pass the inputs via a list file.
+        file_list = os.path.splitext(vrtfile)[0] + "_inputs.txt"
+        with open(file_list, "w") as f:
+            f.writelines(path + "\n" for path in input_files)
+        run_command(cmd + ["-input_file_list", file_list, vrtfile], workdir)
+
+    vrt_stage = Stage("vrt", vrtfile, vrt_params, run_vrt, input_files=input_files)
+
+    def run_warp(threads):
+        cmd = ["gdalwarp", "-overwrite", "-r", resampling]
+        if "s_srs" in warp_opts:
+            cmd += ["-s_srs", warp_opts["s_srs"]]
+        cmd += ["-t_srs", warp_opts.get("t_srs", "EPSG:4326")]
+        if "dstnodata" in warp_opts:
+            cmd += ["-dstnodata", str(warp_opts["dstnodata"])]
+        if "te" in warp_opts:
+            cmd += ["-te"] + [str(v) for v in warp_opts["te"]]
+        if cutline:
+            cmd += ["-cutline", cutline]
+        run_command(cmd + [vrtfile, vrtfile2], workdir)
+
+    warp_stage = Stage(
+        "warp", vrtfile2, warp_params, run_warp,
+        deps=[vrt_stage], input_files=[cutline] if cutline else [],
+    )
+
+    encoding = tile_opts.get("encoding", "mapbox")
+    min_zoom = tile_opts.get("min_zoom", 0)
+    max_zoom = tile_opts["max_zoom"]
+    tile_format = tile_opts.get("format", "webp")
+    label = "Terrarium" if encoding == "terrarium" else "TerrainRGB"
+    mbtiles = os.path.join(output_dir, f"{basename}_{label}_z{min_zoom}-Z{max_zoom}_{resampling}_{tile_format}.mbtiles")
+    tile_params = {
+        "encoding": encoding,
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "format": tile_format,
+        "resampling": resampling,
+        "batch": tile_opts.get("batch", 1),
+        "base_val": tile_opts.get("base_val", -10000),
+        "interval": tile_opts.get("interval", 0.1),
+    }
+    if encoding == "terrarium":
+        # -b and -i are fixed by the terrarium profile
+        del tile_params["base_val"], tile_params["interval"]
+
+    # rio rgbify picks the output type from the extension, so the temporary
+    # file keeps .mbtiles at the end.
+    tmp_mbtiles = os.path.splitext(mbtiles)[0] + ".tmp.mbtiles"
+
+    def run_tile(threads):
+        # rio rgbify appends to an existing file, so start from scratch. Tile
+        # into a temporary file so a failed run keeps the last good output.
+        if os.path.exists(tmp_mbtiles):
+            os.remove(tmp_mbtiles)
+        cmd = ["rio", "rgbify", "-v", "-e", encoding]
+        if encoding != "terrarium":
+            cmd += ["-b", str(tile_params["base_val"]), "-i", str(tile_params["interval"])]
+        cmd += [
+            "--min-z", str(min_zoom), "--max-z", str(max_zoom), "-j", str(threads),
+            "--batch-size", str(tile_params["batch"]), "--resampling", resampling,
+            "--format", tile_format, vrtfile2, tmp_mbtiles,
+        ]
+        run_command(cmd, workdir)
+        os.replace(tmp_mbtiles, mbtiles)
+
+    # The thread count is deliberately left out of the params: it changes the
+    # speed of the run, not its output.
+    tile_stage = Stage(
+        "tile", mbtiles, tile_params, run_tile, deps=[warp_stage],
+        threads=dataset.get("threads", 8),
+    )
+
+    metadata = dataset.get("metadata", {})
+
+    def run_metadata(threads):
+        print(f"  Updating metadata in {mbtiles}")
+        set_metadata(mbtiles, metadata)
+
+    metadata_stage = Stage("metadata", mbtiles, metadata, run_metadata, deps=[tile_stage])
+
+    return stages + [vrt_stage, warp_stage, tile_stage, metadata_stage]
+
+
+def build_dataset(name: str, stages: list[Stage], budget: ThreadBudget, force: bool = False, dry_run: bool = False) -> bool:
+    """Runs the stages of one dataset, skipping those whose fingerprint is unchanged.
+
+    A stage shared with another dataset runs at most once; whichever dataset
+    gets to it second waits for it and then treats it as done.
+
+    Returns:
+        bool: True if every stage is up to date or ran successfully.
+    """
+    output_dir = os.path.dirname(stages[0].output)
+    os.makedirs(output_dir, exist_ok=True)
+
+    for stage in stages:
+        with stage.lock:
+            if stage.ran:
+                print(f"[{name}] {stage.name}: already {'planned' if dry_run else 'built'} for another dataset")
+                continue
+
+            fingerprint = stage.fingerprint()
+            with _state_lock:
+                recorded = load_state(output_dir).get(stage.key)
+            up_to_date = (
+                not force
+                and os.path.exists(stage.output)
+                and recorded == fingerprint
+                and not any(dep.ran for dep in stage.deps)
+            )
+            if up_to_date:
+                print(f"[{name}] {stage.name}: up to date ({fingerprint[:12]})")
+                continue
+
+            if dry_run:
+                stage.ran = True
+                print(f"[{name}] {stage.name}: would run -> {stage.output}")
+                continue
+
+            threads = budget.acquire(stage.threads)
+            print(f"[{name}] {stage.name}: running with {threads} thread(s)")
+            try:
+                stage.run(threads)
+            except (subprocess.CalledProcessError, OSError, sqlite3.Error) as e:
+                print(f"[{name}] {stage.name}: failed: {e}")
+                record_state(output_dir, stage.key)
+                return False
+            finally:
+                budget.release(threads)
+
+            stage.ran = True
+            record_state(output_dir, stage.key, fingerprint)
+
+    return True
+
+
+def share_stages(named_stages) -> list:
+    """Makes datasets that have identical stages use one Stage object for them.
+
+    Two datasets that would write the same file with different settings cannot
+    both be built (they would overwrite each other's output and state), so the
+    later one is dropped with an error.
+
+    Args:
+        named_stages (list[tuple[str, list[Stage]]]): (dataset name, stages) pairs.
+
+    Returns:
+        list[tuple[str, list[Stage]]]: The pairs that can be built, with shared stages.
+    """
+    owners = {}
+    result = []
+    for name, stages in named_stages:
+        replaced = {}
+        resolved = []
+        clash = None
+        for stage in stages:
+            stage.deps = [replaced.get(dep, dep) for dep in stage.deps]
+            existing = owners.get((stage.output, stage.name))
+            if existing is None:
+                resolved.append(stage)
+            elif existing[1].same_as(stage):
+                replaced[stage] = existing[1]
+                resolved.append(existing[1])
+            else:
+                clash = existing[0]
+                break
+        if clash:
+            print(f"[{name}] skipped: writes the same files as {clash} with different settings; use a different basename")
+            continue
+        for stage in resolved:
+            owners.setdefault((stage.output, stage.name), (name, stage))
+        result.append((name, resolved))
+    return result
+
+
+def build_all(config_path: str, threads: int, only: list[str] = None, force: bool = False, dry_run: bool = False) -> bool:
+    """Builds every dataset in a config, running independent datasets concurrently.
+
+    Args:
+        config_path (str): Path to the build JSON config.
+        threads (int): Global thread budget shared by all datasets.
+        only (list[str]): Optional list of dataset names to build.
+        force (bool): Ignore cached fingerprints and rebuild every stage.
+        dry_run (bool): Only report which stages would run.
+
+    Returns:
+        bool: True if all selected datasets built successfully.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+
+    datasets = config["datasets"]
+    if only:
+        datasets = [d for d in datasets if d["name"] in only]
+        missing = set(only) - {d["name"] for d in datasets}
+        if missing:
+            print(f"Warning: unknown dataset(s): {', '.join(sorted(missing))}")
+
+    ok = True
+    named_stages = []
+    for dataset in datasets:
+        try:
+            named_stages.append((dataset["name"], build_stages(dataset, base_dir)))
+        except (ValueError, KeyError, OSError) as e:
+            print(f"[{dataset.get('name')}] skipped: {e}")
+            ok = False
+    planned = share_stages(named_stages)
+    if len(planned) < len(named_stages):
+        ok = False
+
+    budget = ThreadBudget(threads)
+    print(f"Building {len(planned)} dataset(s) with a budget of {budget.total} threads")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(planned))) as executor:
+        futures = {}
+        for name, stages in planned:
+            futures[executor.submit(build_dataset, name, stages, budget, force, dry_run)] = name
+
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            if future.result():
+                print(f"[{name}] done")
+            else:
+                ok = False
+
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build dataset MBTiles (VRT -> warp -> rio rgbify -> metadata), skipping unchanged stages.")
+    parser.add_argument("config", help="Path to the build JSON config (see datasets/build_datasets.json).")
+    parser.add_argument("-j", "--threads", type=int, default=os.cpu_count() or 8, help="Global thread budget shared by all datasets.")
+    parser.add_argument("--only", nargs="+", help="Only build the named datasets.")
+    parser.add_argument("--force", action="store_true", help="Rebuild every stage even if its fingerprint is unchanged.")
+    parser.add_argument("--dry-run", action="store_true", help="Print which stages would run without running them.")
+    args = parser.parse_args()
+
+    if not build_all(args.config, args.threads, args.only, args.force, args.dry_run):
+        raise SystemExit(1)
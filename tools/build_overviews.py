@@ -0,0 +1,229 @@
+import argparse
+import concurrent.futures
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+from PIL import Image
+
+from mbtiles_utils import insert_tiles, is_deduplicated, read_metadata, remove_unused_tile_data, write_metadata
+from terrain_codec import DEFAULT_NODATA, RESAMPLING, decode_tile, encode_tile
+
+BATCH_SIZE = 256
+
+
+def downsample(mosaic: np.ndarray, valid: np.ndarray, size: int, resampling: str) -> tuple[np.ndarray, np.ndarray]:
+    """Downsamples a 2x2 child mosaic to one tile, ignoring nodata pixels.
+
+    Elevations and the validity mask are resampled separately and divided
+    (normalized convolution), so nodata never bleeds into valid pixels.
+    """
+    if resampling == "nearest":
+        return mosaic[::2, ::2], valid[::2, ::2]
+
+    filt = RESAMPLING[resampling]
+    weights = valid.astype(np.float32)
+    weighted = Image.fromarray(np.where(valid, mosaic, 0).astype(np.float32), mode="F").resize((size, size), filt)
+    coverage = np.asarray(Image.fromarray(weights, mode="F").resize((size, size), filt))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        elevations = np.asarray(weighted) / coverage
+    return elevations, coverage >= 0.5
+
+
+def build_parent_tiles(read_path: str, zoom: int, parents, encoding: str, interval: float, base_val: float, nodata: float, resampling: str, tile_format: str):
+    """Builds the tiles at zoom from their four children at zoom + 1.
+
+    Args:
+        read_path (str): MBTiles file holding the children.
+        zoom (int): Zoom level of the tiles to build.
+        parents (list[tuple[int, int]]): (tile_column, tile_row) TMS coordinates to build.
+
+    Returns:
+        list[tuple]: (zoom_level, tile_column, tile_row, tile_data) rows.
+    """
+    conn = sqlite3.connect(f"file:{read_path}?mode=ro", uri=True, timeout=60)
+    cursor = conn.cursor()
+    rows = []
+    try:
+        for px, py in parents:
+            cursor.execute(
+                "SELECT tile_column, tile_row, tile_data FROM tiles "
+                "WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                (zoom + 1, px * 2, px * 2 + 1, py * 2, py * 2 + 1),
+            )
+            children = {}
+            size = None
+            for cx, cy, data in cursor.fetchall():
+                try:
+                    children[(cx - px * 2, cy - py * 2)] = decode_tile(data, encoding, interval=interval, base_val=base_val)
+                except Exception as e:
+                    print(f"Error decoding tile {zoom + 1}/{cx}/{cy}: {e}")
+                    continue
+                size = children[(cx - px * 2, cy - py * 2)].shape[0]
+            if not children:
+                continue
+
+            mosaic = np.full((size * 2, size * 2), nodata, dtype=np.float64)
+            for (dx, dy), elevations in children.items():
+                # TMS rows grow northwards, image rows grow southwards
+                row = (1 - dy) * size
+                mosaic[row:row + size, dx * size:dx * size + size] = elevations
+            valid = ~np.isclose(mosaic, nodata)
+
+            elevations, valid = downsample(mosaic, valid, size, resampling)
+            if not valid.any():
+                continue
+            elevations = np.where(valid, elevations, nodata)
+            rows.append((zoom, px, py, encode_tile(elevations, encoding, tile_format, interval=interval, base_val=base_val)))
+    finally:
+        conn.close()
+    return rows
+
+
+def build_overviews(mbtiles_path: str, output_path: str = None, max_zoom: int = None, min_zoom: int = 0, encoding: str = 'mapbox',
+                    interval: float = 0.1, base_val: float = -10000.0, nodata: float = None, resampling: str = 'cubic',
+                    tile_format: str = None, workers: int = None):
+    """Rebuilds zoom levels max_zoom-1 ... min_zoom of an MBTiles from max_zoom.
+
+    Each level is built from the one above it by decoding the four children of
+    every tile, downsampling them and re-encoding. Levels are processed one at a
+    time; within a level, batches of tiles are built in a process pool and
+    written to a temporary table as they complete. Only once the whole level
+    is built are its old tiles replaced, in one transaction, so a failed run
+    leaves every level intact (levels above the failure already rebuilt).
+
+    Args:
+        mbtiles_path (str): Source MBTiles file.
+        output_path (str): Optional copy to write to; the source is updated in place if omitted.
+        max_zoom (int): Level to build from (defaults to the highest level in the file).
+        min_zoom (int): Lowest level to build.
+        nodata (float): Elevation treated as nodata (defaults to the encoding's usual value).
+        tile_format (str): 'png' or 'webp' (defaults to the 'format' metadata).
+        workers (int): Number of worker processes.
+    """
+    if output_path and os.path.abspath(output_path) != os.path.abspath(mbtiles_path):
+        print(f"Copying {mbtiles_path} to {output_path}")
+        shutil.copyfile(mbtiles_path, output_path)
+        mbtiles_path = output_path
+
+    metadata = read_metadata(mbtiles_path)
+    tile_format = tile_format or metadata.get("format", "png")
+    if nodata is None:
+        nodata = DEFAULT_NODATA[encoding] if encoding == "terrarium" else base_val
+    workers = workers or os.cpu_count() or 8
+
+    conn = sqlite3.connect(mbtiles_path, timeout=60)
+    cur = conn.cursor()
+    deduplicated = is_deduplicated(cur)
+    if not deduplicated:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index on tiles (zoom_level, tile_column, tile_row);")
+
+    if max_zoom is None:
+        (max_zoom,) = cur.execute("SELECT MAX(zoom_level) FROM tiles").fetchone()
+    if max_zoom is None or max_zoom <= min_zoom:
+        print(f"Nothing to build (max zoom {max_zoom}, min zoom {min_zoom})")
+        conn.close()
+        return
+
+    print(f"Rebuilding z{max_zoom - 1}-z{min_zoom} of {mbtiles_path} from z{max_zoom}")
+    print(f"Encoding: {encoding}, Format: {tile_format}, Resampling: {resampling}, Nodata: {nodata}, Workers: {workers}")
+
+    cur.execute(
+        "CREATE TEMP TABLE level_tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)"
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for zoom in range(max_zoom - 1, min_zoom - 1, -1):
+            cur.execute(
+                "SELECT DISTINCT tile_column / 2, tile_row / 2 FROM tiles WHERE zoom_level = ?", (zoom + 1,)
+            )
+            parents = cur.fetchall()
+            batches = [parents[i:i + BATCH_SIZE] for i in range(0, len(parents), BATCH_SIZE)]
+            print(f"  z{zoom}: building {len(parents)} tiles in {len(batches)} batches...")
+
+            written = 0
+            pending = set()
+            batch_iter = iter(batches)
+            # Keep a bounded number of batches in flight so results are written
+            # as they arrive instead of piling up in memory.
+            while True:
+                while len(pending) < workers * 2:
+                    batch = next(batch_iter, None)
+                    if batch is None:
+                        break
+                    pending.add(executor.submit(
+                        build_parent_tiles, mbtiles_path, zoom, batch, encoding, interval, base_val, nodata, resampling, tile_format
+                    ))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        rows = future.result()
+                    except Exception as e:
+                        print(f"  z{zoom}: building a batch failed: {e}")
+                        print(f"  z{zoom}-z{min_zoom} were left unchanged")
+                        for other in pending:
+                            other.cancel()
+                        conn.close()
+                        raise
+                    cur.executemany("INSERT INTO temp.level_tiles VALUES (?, ?, ?, ?)", rows)
+                    conn.commit()
+                    written += len(rows)
+
+            # Swap the level in one transaction
+            if deduplicated:
+                cur.execute("DELETE FROM tiles_shallow WHERE TILES_COL_Z = ?", (zoom,))
+            else:
+                cur.execute("DELETE FROM tiles WHERE zoom_level = ?", (zoom,))
+            read_cur = conn.cursor()
+            read_cur.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM temp.level_tiles")
+            while True:
+                rows = read_cur.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                insert_tiles(cur, rows, deduplicated=deduplicated)
+            cur.execute("DELETE FROM temp.level_tiles")
+            conn.commit()
+            print(f"  z{zoom}: wrote {written} tiles")
+
+    if deduplicated:
+        remove_unused_tile_data(cur)
+    # Levels below min_zoom were left alone, so take the lowest level actually present
+    (lowest,) = cur.execute("SELECT MIN(zoom_level) FROM tiles").fetchone()
+    if lowest is not None:
+        write_metadata(cur, {"minzoom": lowest})
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the lower zoom levels of a TerrainRGB/Terrarium MBTiles from its max zoom.")
+    parser.add_argument("mbtiles_file", help="Path to MBTiles file")
+    parser.add_argument("-o", "--output", default=None, help="Write to a copy instead of updating the file in place.")
+    parser.add_argument("--max-zoom", type=int, default=None, help="Zoom level to build from (default: highest in file).")
+    parser.add_argument("--min-zoom", type=int, default=0, help="Lowest zoom level to build.")
+    parser.add_argument("-e", "--encoding", choices=['terrarium', 'mapbox'], default='mapbox', help="Encoding")
+    parser.add_argument("--interval", type=float, default=0.1, help="Mapbox interval")
+    parser.add_argument("--base-val", type=float, default=-10000.0, help="Mapbox base value")
+    parser.add_argument("--nodata", type=float, default=None, help="Elevation treated as nodata (default: base value for mapbox, -32768 for terrarium).")
+    parser.add_argument("--resampling", default='cubic', choices=sorted(RESAMPLING), help="Resampling method for downsampling.")
+    parser.add_argument("--format", default=None, choices=['png', 'webp'], help="Output tile format (default: from metadata).")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    build_overviews(
+        args.mbtiles_file,
+        args.output,
+        args.max_zoom,
+        args.min_zoom,
+        args.encoding,
+        args.interval,
+        args.base_val,
+        args.nodata,
+        args.resampling,
+        args.format,
+        args.workers,
+    )
+    print("Overviews rebuilt!")
@@ -0,0 +1,268 @@
+import argparse
+import concurrent.futures
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from mbtiles_utils import read_metadata, write_metadata
+from terrain_codec import decode_tile, image_to_bytes
+
+BATCH_SIZE = 256
+
+# Set in each worker by init_worker so the lookup table is only sent once per process
+_lut = None
+
+
+def parse_ramp(ramp_path: str):
+    """Reads a gdaldem color-relief ramp file.
+
+    Each line is "elevation r g b [a]" (space, tab, comma or colon separated).
+    An "nv" line gives the nodata color. Percentage entries are not supported
+    since they depend on raster statistics.
+
+    Returns:
+        tuple: (elevations (N,), colors (N, 4) uint8 sorted by elevation, nodata color or None)
+    """
+    entries = []
+    nodata_color = None
+    with open(ramp_path, encoding="utf-8-sig") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = [p for p in re.split(r"[\s,:]+", line) if p]
+            if len(parts) < 4:
+                raise ValueError(f"{ramp_path}:{line_no}: expected 'value r g b [a]', got {line!r}")
+            color = [int(v) for v in parts[1:5]] + ([255] if len(parts) == 4 else [])
+            if parts[0].lower() == "nv":
+                nodata_color = color
+            elif parts[0].endswith("%"):
+                raise ValueError(f"{ramp_path}:{line_no}: percentage entries are not supported")
+            else:
+                entries.append((float(parts[0]), color))
+
+    if not entries:
+        raise ValueError(f"{ramp_path}: no color entries")
+    # Stable sort, so entries with the same elevation keep their file order like gdaldem
+    entries.sort(key=lambda e: e[0])
+    elevations = np.array([e[0] for e in entries], dtype=np.float64)
+    colors = np.array([e[1] for e in entries], dtype=np.uint8)
+    return elevations, colors, nodata_color
+
+
+def build_lut(elevations: np.ndarray, colors: np.ndarray, step: float, nearest: bool = False) -> dict:
+    """Precomputes the RGBA color for every step between the lowest and highest ramp entry.
+
+    Values outside the ramp clamp to the end colors, as gdaldem does.
+    """
+    lo, hi = elevations[0], elevations[-1]
+    count = int(round((hi - lo) / step)) + 1
+    samples = lo + np.arange(count) * step
+    if nearest:
+        idx = np.clip(np.searchsorted(elevations, samples), 1, len(elevations) - 1)
+        left_closer = (samples - elevations[idx - 1]) <= (elevations[idx] - samples)
+        table = colors[np.where(left_closer, idx - 1, idx)]
+    else:
+        table = np.stack(
+            [np.interp(samples, elevations, colors[:, c].astype(np.float64)) for c in range(4)], axis=-1
+        )
+        table = np.rint(table).astype(np.uint8)
+    return {"lo": lo, "step": step, "table": table}
+
+
+def apply_lut(elevations: np.ndarray, lut: dict, nodata_mask: np.ndarray = None, nodata_color=None) -> np.ndarray:
+    table = lut["table"]
+    idx = np.clip(np.rint((elevations - lut["lo"]) / lut["step"]), 0, len(table) - 1).astype(np.intp)
+    rgba = table[idx]
+    if nodata_mask is not None and nodata_mask.any():
+        rgba[nodata_mask] = nodata_color if nodata_color is not None else (0, 0, 0, 0)
+    return rgba
+
+
+def init_worker(lut):
+    global _lut
+    _lut = lut
+
+
+def render_tiles(mbtiles_path: str, tiles, encoding: str, interval: float, base_val: float, nodata_values, nodata_color, tile_format: str):
+    """Decodes a batch of elevation tiles and renders them through the lookup table."""
+    conn = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    rows = []
+    try:
+        for z, x, y in tiles:
+            cursor.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, y)
+            )
+            result = cursor.fetchone()
+            if result is None:
+                continue
+            try:
+                elevations = decode_tile(result[0], encoding, interval=interval, base_val=base_val)
+            except Exception as e:
+                print(f"Error decoding tile {z}/{x}/{y}: {e}")
+                continue
+            nodata_mask = None
+            if nodata_values:
+                nodata_mask = np.zeros(elevations.shape, dtype=bool)
+                for nodata_val in nodata_values:
+                    nodata_mask |= np.isclose(elevations, nodata_val, rtol=0, atol=1e-3)
+            rgba = apply_lut(elevations, _lut, nodata_mask, nodata_color)
+            rows.append((z, x, y, image_to_bytes(rgba, tile_format)))
+    finally:
+        conn.close()
+    return rows
+
+
+def render_color_relief(mbtiles_path: str, ramp_path: str, output_path: str, encoding: str = 'mapbox', interval: float = 0.1,
+                        base_val: float = -10000.0, nodata_values=None, step: float = None, nearest: bool = False,
+                        tile_format: str = 'png', min_zoom: int = None, max_zoom: int = None, workers: int = None):
+    """Renders a color MBTiles from a TerrainRGB/Terrarium MBTiles using a gdaldem ramp.
+
+    Args:
+        mbtiles_path (str): Source elevation MBTiles.
+        ramp_path (str): gdaldem color-relief ramp (e.g. datasets/GEBCO/ramp_bathymetry.ramp).
+        output_path (str): Color MBTiles to create (overwritten if it exists).
+        nodata_values (list[float]): Decoded elevations rendered with the ramp's nv color (transparent if none).
+        step (float): Lookup table resolution in meters (defaults to the mapbox interval).
+        nearest (bool): Use the nearest ramp entry instead of interpolating (gdaldem -nearest_color_entry).
+        tile_format (str): 'png' or 'webp'.
+        workers (int): Number of worker processes.
+    """
+    ramp_elevations, ramp_colors, nodata_color = parse_ramp(ramp_path)
+    lut = build_lut(ramp_elevations, ramp_colors, step or interval, nearest)
+    print(f"Ramp {ramp_path}: {len(ramp_elevations)} entries, {len(lut['table'])} LUT steps of {lut['step']} m")
+
+    if nodata_values is None:
+        nodata_values = [base_val] if encoding == "mapbox" else [-32768.0]
+    workers = workers or os.cpu_count() or 8
+
+    if not os.path.isfile(mbtiles_path):
+        raise FileNotFoundError(f"MBTiles not found: {mbtiles_path}")
+    src_conn = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    src_cur = src_conn.cursor()
+    where = ""
+    conditions, params = [], []
+    if min_zoom is not None:
+        conditions.append("zoom_level >= ?")
+        params.append(min_zoom)
+    if max_zoom is not None:
+        conditions.append("zoom_level <= ?")
+        params.append(max_zoom)
+    if conditions:
+        where = " WHERE " + " AND ".join(conditions)
+    (total, first_zoom, last_zoom) = src_cur.execute(
+        "SELECT COUNT(*), MIN(zoom_level), MAX(zoom_level) FROM tiles" + where, params
+    ).fetchone()
+    print(f"Rendering {total} tiles with {workers} workers...")
+
+    # Render into a temporary file so a failed run leaves no half-finished output
+    tmp_path = output_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);")
+    cur.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);")
+    cur.execute("CREATE TABLE metadata (name text, value text);")
+
+    src_metadata = read_metadata(mbtiles_path)
+    metadata = {
+        "name": os.path.splitext(os.path.basename(output_path))[0],
+        "format": tile_format,
+        "type": "baselayer",
+        "description": f"{os.path.basename(mbtiles_path)} rendered with {os.path.basename(ramp_path)}",
+    }
+    if total:
+        metadata.update({"minzoom": first_zoom, "maxzoom": last_zoom})
+    for name in ("bounds", "center", "attribution"):
+        if name in src_metadata:
+            metadata[name] = src_metadata[name]
+    write_metadata(cur, metadata)
+    conn.commit()
+
+    # Tile coordinates are streamed from the source in batches instead of
+    # being loaded up front.
+    src_cur.execute("SELECT zoom_level, tile_column, tile_row FROM tiles" + where + " ORDER BY zoom_level, tile_column, tile_row", params)
+    written = 0
+    done_batches = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(lut,)) as executor:
+            pending = set()
+            # Keep a bounded number of batches in flight so rendered tiles are
+            # written and dropped as they arrive instead of piling up in memory.
+            while True:
+                while len(pending) < workers * 2:
+                    batch = src_cur.fetchmany(BATCH_SIZE)
+                    if not batch:
+                        break
+                    pending.add(executor.submit(
+                        render_tiles, mbtiles_path, batch, encoding, interval, base_val, nodata_values, nodata_color, tile_format
+                    ))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        rows = future.result()
+                    except Exception as e:
+                        print(f"  Error rendering batch: {e}")
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    cur.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)", rows)
+                    conn.commit()
+                    written += len(rows)
+                    done_batches += 1
+                    if done_batches % 40 == 0:
+                        print(f"  Rendered {written}/{total} tiles...")
+    except BaseException:
+        conn.close()
+        src_conn.close()
+        os.remove(tmp_path)
+        raise
+
+    print(f"  Rendered {written}/{total} tiles")
+    conn.close()
+    src_conn.close()
+    os.replace(tmp_path, output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a color-relief MBTiles from a TerrainRGB/Terrarium MBTiles and a gdaldem .ramp file.")
+    parser.add_argument("mbtiles_file", help="Path to the elevation MBTiles file")
+    parser.add_argument("ramp_file", help="Path to the gdaldem color ramp (e.g. ramp_bathymetry.ramp)")
+    parser.add_argument("output", help="Path to the color MBTiles file to create")
+    parser.add_argument("-e", "--encoding", choices=['terrarium', 'mapbox'], default='mapbox', help="Encoding")
+    parser.add_argument("--interval", type=float, default=0.1, help="Mapbox interval")
+    parser.add_argument("--base-val", type=float, default=-10000.0, help="Mapbox base value")
+    parser.add_argument("--nodata", nargs='+', type=float, default=None, help="Elevations to render as nodata (e.g. the mask_values of the merge config).")
+    parser.add_argument("--step", type=float, default=None, help="Lookup table resolution in meters (default: the mapbox interval).")
+    parser.add_argument("--nearest", action="store_true", help="Use the nearest ramp color instead of interpolating.")
+    parser.add_argument("--format", default='png', choices=['png', 'webp'], help="Output tile format.")
+    parser.add_argument("--min-zoom", type=int, default=None, help="Lowest zoom level to render.")
+    parser.add_argument("--max-zoom", type=int, default=None, help="Highest zoom level to render.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    try:
+        render_color_relief(
+            args.mbtiles_file,
+        args.ramp_file,
+        args.output,
+        args.encoding,
+        args.interval,
+        args.base_val,
+        args.nodata,
+        args.step,
+        args.nearest,
+        args.format,
+        args.min_zoom,
+        args.max_zoom,
+            args.workers,
+        )
+    except FileNotFoundError as e:
+        raise SystemExit(f"Error: {e}")
+    print(f"Color relief written to: {args.output}")
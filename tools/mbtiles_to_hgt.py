@@ -7,11 +7,14 @@ import argparse
 import sqlite3
 import concurrent.futures
 import math
+import time
 import rasterio
 from rasterio.enums import Resampling
 from rasterio.warp import reproject
 from rasterio.io import MemoryFile
 
+from stage_profiler import NULL_STATS, PipelineProfile, StageStats, start_worker_profiler
+
 # --- Decoding Functions ---
 def decode_elevation_from_rgb_rio(data: np.ndarray, encoding: str, interval: float = 0.1, base_val: float = -10000.0) -> np.ndarray:
     data = data.astype(np.float64)
@@ -20,7 +23,8 @@ def decode_elevation_from_rgb_rio(data: np.ndarray, encoding: str, interval: flo
     else: # 'mapbox' encoding
         return base_val + (((data[..., 0] * 256.0 * 256.0) + (data[..., 1] * 256.0) + data[..., 2]) * interval)
 
-def process_tile_data_with_debug(tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, tile_src_crs):
+def process_tile_data_with_debug(tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, tile_src_crs, stats=None):
+    stats = stats or NULL_STATS
     # Debugging prints for a few pixels from the first tile (or a tile you know has positive elevation)
     tile_z, tile_x, tile_y = tile_info
     
@@ -30,20 +34,24 @@ def process_tile_data_with_debug(tile_info, mbtiles_path, encoding, interval, ba
 
     conn = None
     try:
-        conn = sqlite3.connect(mbtiles_path)
-        cursor = conn.cursor()
+        with stats.stage("fetch") as stage:
+            conn = sqlite3.connect(mbtiles_path)
+            cursor = conn.cursor()
 
-        tile_data_query = "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
-        cursor.execute(tile_data_query, (tile_z, tile_x, tile_y))
-        result = cursor.fetchone()
+            tile_data_query = "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+            cursor.execute(tile_data_query, (tile_z, tile_x, tile_y))
+            result = cursor.fetchone()
+            stage["bytes"] = len(result[0]) if result else 0
 
         if result is None:
             # print(f"Warning: No data found for tile {tile_z}/{tile_x}/{tile_y}") # Suppress for cleaner output unless debugging
             return None
 
         tile_data_bytes = result[0]
-        img = Image.open(io.BytesIO(tile_data_bytes)).convert("RGB")
-        pixels = np.array(img)
+        with stats.stage("decode_image") as stage:
+            img = Image.open(io.BytesIO(tile_data_bytes)).convert("RGB")
+            pixels = np.array(img)
+            stage["bytes"] = pixels.nbytes
         #print(f"\n--- Debugging for tile {tile_z}/{tile_x}/{tile_y} ---")
         #print(f"Sample RGB values (top-left 3x3):")
         #for r in range(min(3, pixels.shape[0])):
@@ -55,17 +63,19 @@ def process_tile_data_with_debug(tile_info, mbtiles_path, encoding, interval, ba
         #        print(f"  RGB: {rgb}, Numeric: {numeric_value:.0f}, Scaled: {scaled_value:.2f}, Decoded Elev: {decoded_elev:.2f}")
         #print(f"--- End Debugging ---")
 
-        # Decode elevations
-        elevations = decode_elevation_from_rgb_rio(pixels, encoding, interval=interval, base_val=base_val)
-        
-        # Apply nodata handling from source_nodata_values if provided
-        if source_nodata_values:
-            for nodata_val in source_nodata_values:
-                elevations[np.isclose(elevations, nodata_val, rtol=1e-09, atol=1e-09)] = -32768.0
-        
-        # Ensure NaNs and extreme values become nodata, as done previously.
-        elevations[np.isnan(elevations)] = -32768.0
-        elevations[(elevations < -30000) | (elevations > 15000)] = -32768.0 # Clamping as per your original logic
+        with stats.stage("decode_elevation") as stage:
+            # Decode elevations
+            elevations = decode_elevation_from_rgb_rio(pixels, encoding, interval=interval, base_val=base_val)
+
+            # Apply nodata handling from source_nodata_values if provided
+            if source_nodata_values:
+                for nodata_val in source_nodata_values:
+                    elevations[np.isclose(elevations, nodata_val, rtol=1e-09, atol=1e-09)] = -32768.0
+
+            # Ensure NaNs and extreme values become nodata, as done previously.
+            elevations[np.isnan(elevations)] = -32768.0
+            elevations[(elevations < -30000) | (elevations > 15000)] = -32768.0 # Clamping as per your original logic
+            stage["bytes"] = elevations.nbytes
 
         bounds = mercantile.bounds(tile)
         height, width = elevations.shape
@@ -125,7 +135,15 @@ def process_tile_data_with_debug(tile_info, mbtiles_path, encoding, interval, ba
         if conn:
             conn.close()
 
-def create_hgt_with_proper_merging_flexible(tile_data_list, hgt_bounds, output_path, resampling_method=Resampling.bilinear):
+def process_tile_data_profiled(tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, tile_src_crs, trace=False, code_profiler=None, profile_dir=None):
+    """Runs process_tile_data_with_debug with stage timers and returns (result, worker pid, stats)."""
+    start_worker_profiler(code_profiler, profile_dir)
+    stats = StageStats(trace=trace, tile="/".join(str(v) for v in tile_info))
+    result = process_tile_data_with_debug(tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, tile_src_crs, stats=stats)
+    return result, os.getpid(), stats.to_dict()
+
+def create_hgt_with_proper_merging_flexible(tile_data_list, hgt_bounds, output_path, resampling_method=Resampling.bilinear, stats=None):
+    stats = stats or NULL_STATS
     west, south, east, north = hgt_bounds
     
     hgt_width, hgt_height = 3601, 3601
@@ -140,37 +158,41 @@ def create_hgt_with_proper_merging_flexible(tile_data_list, hgt_bounds, output_p
 
     for i, tile_data in enumerate(tile_data_list):
         try:
-            temp_elevation = np.full((hgt_height, hgt_width), np.nan, dtype=np.float32)
-            
-            reproject(
-                source=tile_data['elevations'],
-                destination=temp_elevation,
-                src_transform=tile_data['transform'],
-                src_crs=tile_data['src_crs'],
-                dst_transform=hgt_transform,
-                dst_crs='EPSG:4326',
-                resampling=resampling_method,
-                src_nodata=np.nan,
-                dst_nodata=np.nan
-            )
-            
-            valid_mask = (~np.isnan(temp_elevation)) & (temp_elevation > -30000) & (temp_elevation < 15000)
-            
-            if np.any(valid_mask):
-                any_valid_data_in_hgt = True # Mark that we've written some data to this HGT grid
-                
-                first_data_mask = np.isnan(hgt_elevation) & valid_mask
-                hgt_elevation[first_data_mask] = temp_elevation[first_data_mask]
-                hgt_count[first_data_mask] = 1
-                
-                additional_data_mask = (~np.isnan(hgt_elevation)) & valid_mask
-                if np.any(additional_data_mask):
-                    current_count = hgt_count[additional_data_mask]
-                    current_sum = hgt_elevation[additional_data_mask] * current_count
-                    new_sum = current_sum + temp_elevation[additional_data_mask]
-                    new_count = current_count + 1
-                    hgt_elevation[additional_data_mask] = new_sum / new_count
-                    hgt_count[additional_data_mask] = new_count
+            with stats.stage("reproject") as stage:
+                temp_elevation = np.full((hgt_height, hgt_width), np.nan, dtype=np.float32)
+
+                reproject(
+                    source=tile_data['elevations'],
+                    destination=temp_elevation,
+                    src_transform=tile_data['transform'],
+                    src_crs=tile_data['src_crs'],
+                    dst_transform=hgt_transform,
+                    dst_crs='EPSG:4326',
+                    resampling=resampling_method,
+                    src_nodata=np.nan,
+                    dst_nodata=np.nan
+                )
+                stage["bytes"] = temp_elevation.nbytes
+
+            with stats.stage("merge") as stage:
+                valid_mask = (~np.isnan(temp_elevation)) & (temp_elevation > -30000) & (temp_elevation < 15000)
+
+                if np.any(valid_mask):
+                    any_valid_data_in_hgt = True # Mark that we've written some data to this HGT grid
+
+                    first_data_mask = np.isnan(hgt_elevation) & valid_mask
+                    hgt_elevation[first_data_mask] = temp_elevation[first_data_mask]
+                    hgt_count[first_data_mask] = 1
+
+                    additional_data_mask = (~np.isnan(hgt_elevation)) & valid_mask
+                    if np.any(additional_data_mask):
+                        current_count = hgt_count[additional_data_mask]
+                        current_sum = hgt_elevation[additional_data_mask] * current_count
+                        new_sum = current_sum + temp_elevation[additional_data_mask]
+                        new_count = current_count + 1
+                        hgt_elevation[additional_data_mask] = new_sum / new_count
+                        hgt_count[additional_data_mask] = new_count
+                stage["bytes"] = valid_mask.nbytes
             # else:
                 # print(f"    Tile {i+1}: no valid data according to mask") # Uncomment for detailed debugging
                 
@@ -184,9 +206,11 @@ def create_hgt_with_proper_merging_flexible(tile_data_list, hgt_bounds, output_p
         print(f"  No valid data was written to the HGT grid for {output_path} from any tile.")
         return False
     
-    final_elevation = np.where(np.isnan(hgt_elevation), -32768.0, hgt_elevation)
-    hgt_int16 = np.clip(np.round(final_elevation), -32767, 32767).astype(np.int16)
-    hgt_int16[final_elevation == -32768.0] = -32768
+    with stats.stage("finalize") as stage:
+        final_elevation = np.where(np.isnan(hgt_elevation), -32768.0, hgt_elevation)
+        hgt_int16 = np.clip(np.round(final_elevation), -32767, 32767).astype(np.int16)
+        hgt_int16[final_elevation == -32768.0] = -32768
+        stage["bytes"] = final_elevation.nbytes + hgt_int16.nbytes
 
     valid_pixels = np.sum(hgt_int16 != -32768)
     total_pixels = hgt_int16.size
@@ -202,15 +226,34 @@ def create_hgt_with_proper_merging_flexible(tile_data_list, hgt_bounds, output_p
         return False
     
     try:
-        with open(output_path, 'wb') as f:
-            f.write(hgt_int16.astype('>i2').tobytes())
+        with stats.stage("write") as stage:
+            data = hgt_int16.astype('>i2').tobytes()
+            with open(output_path, 'wb') as f:
+                f.write(data)
+            stage["bytes"] = len(data)
         return True
     except Exception as e:
         print(f"  Error saving HGT file '{output_path}': {e}")
         return False
 
-def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, encoding='mapbox', interval=0.1, base_val=-10000.0, source_nodata_values=None, tile_src_crs_arg='EPSG:3857', resampling_method=Resampling.bilinear):
-    
+def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, encoding='mapbox', interval=0.1, base_val=-10000.0, source_nodata_values=None, tile_src_crs_arg='EPSG:3857', resampling_method=Resampling.bilinear, profile=False, profile_dir=None, code_profiler=None):
+    """Converts one zoom level of a TerrainRGB/Terrarium MBTiles into 1x1 degree HGT files.
+
+    With profile=True (implied by profile_dir) every tile and HGT cell is timed per
+    stage (fetch, decode_image, decode_elevation, reproject, merge, finalize, write)
+    and a summary is printed at the end, however the conversion ends. profile_dir
+    also receives profile.json, a Chrome trace and, with code_profiler ('cprofile'
+    or 'sample', requires profile_dir), a code profile of the main process and
+    each worker.
+    """
+    profiler = PipelineProfile(profile_dir, code_profiler) if (profile or profile_dir) else None
+    try:
+        _convert_mbtiles_to_hgt(mbtiles_path, output_dir, zoom_level, encoding, interval, base_val, source_nodata_values, resampling_method, profiler)
+    finally:
+        if profiler:
+            profiler.finish()
+
+def _convert_mbtiles_to_hgt(mbtiles_path, output_dir, zoom_level, encoding, interval, base_val, source_nodata_values, resampling_method, profiler):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         
@@ -243,9 +286,14 @@ def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, enc
     processed_tiles = []
     num_workers = min(8, os.cpu_count() or 8)
     
+    tile_phase_start = time.perf_counter()
     with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-        futures = {executor.submit(process_tile_data_with_debug, tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, source_crs_for_worker): tile_info 
-                 for tile_info in all_tiles}
+        if profiler:
+            futures = {executor.submit(process_tile_data_profiled, tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, source_crs_for_worker, profiler.trace, profiler.code_profiler, profiler.output_dir): tile_info
+                     for tile_info in all_tiles}
+        else:
+            futures = {executor.submit(process_tile_data_with_debug, tile_info, mbtiles_path, encoding, interval, base_val, source_nodata_values, source_crs_for_worker): tile_info 
+                     for tile_info in all_tiles}
         
         tile_count = 0
         for future in concurrent.futures.as_completed(futures):
@@ -254,10 +302,15 @@ def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, enc
                 print(f"  Processed {tile_count}/{len(all_tiles)} tiles...")
             try:
                 result = future.result()
+                if profiler:
+                    result, worker_pid, worker_stats = result
+                    profiler.add_worker_result(worker_pid, worker_stats)
                 if result:
                     processed_tiles.append(result)
             except Exception as e:
                 print(f"  Error processing tile result: {e}")
+    if profiler:
+        profiler.phases["tiles"] = time.perf_counter() - tile_phase_start
 
     print(f"Successfully processed {len(processed_tiles)} tiles")
     
@@ -288,6 +341,7 @@ def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, enc
             hgt_cells_to_generate.append((lat, lon))
     
     print(f"Generating {len(hgt_cells_to_generate)} HGT files...")
+    hgt_phase_start = time.perf_counter()
     
     for hgt_lat, hgt_lon in hgt_cells_to_generate:
         hgt_bounds = (hgt_lon, hgt_lat, hgt_lon + 1, hgt_lat + 1)
@@ -309,7 +363,8 @@ def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, enc
         
         print(f"  Creating {hgt_filename} from {len(overlapping_tiles)} tiles...")
         
-        success = create_hgt_with_proper_merging_flexible(overlapping_tiles, hgt_bounds, hgt_filepath, resampling_method=resampling_method)
+        cell_stats = profiler.item(hgt_filename) if profiler else None
+        success = create_hgt_with_proper_merging_flexible(overlapping_tiles, hgt_bounds, hgt_filepath, resampling_method=resampling_method, stats=cell_stats)
         
         if success:
             print(f"  ✓ Successfully created {hgt_filename}")
@@ -317,6 +372,8 @@ def convert_mbtiles_to_hgt_flexible(mbtiles_path, output_dir, zoom_level=12, enc
             print(f"  ✗ Failed to create {hgt_filename}")
             
     print("Conversion completed!")
+    if profiler:
+        profiler.phases["hgt_cells"] = time.perf_counter() - hgt_phase_start
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fixed MBTiles to HGT converter")
@@ -336,8 +393,13 @@ if __name__ == "__main__":
     parser.add_argument("--tile-src-crs", default='EPSG:4326', help="CRS of the source MBTiles tiles (e.g., EPSG:4326, EPSG:3857). This is mostly informational for debugging. Reprojection will use EPSG:4326 for source interpretation based on mercantile bounds.")
     
     parser.add_argument("--resampling", default='bilinear', choices=['nearest', 'bilinear', 'cubic', 'average'], help="Resampling method for upscaling.")
+    parser.add_argument("--profile", action="store_true", help="Time each pipeline stage per worker and HGT cell and print a summary.")
+    parser.add_argument("--profile-dir", default=None, help="Write profile.json, a Chrome trace (trace.json) and code profiles here (implies --profile).")
+    parser.add_argument("--code-profiler", choices=['cprofile', 'sample'], default=None, help="With --profile-dir, also dump a cProfile (.prof) or sampled stacks (.folded) for the main process and each worker.")
 
     args = parser.parse_args()
+    if args.code_profiler and not args.profile_dir:
+        parser.error("--code-profiler requires --profile-dir")
 
     resampling_map = {
         'nearest': Resampling.nearest,
@@ -359,5 +421,8 @@ if __name__ == "__main__":
         # mercantile.bounds provides lat/lon, which aligns with EPSG:4326.
         # The original --tile-src-crs argument is more for understanding the origin of the data.
         'EPSG:4326', 
-        selected_resampling
+        selected_resampling,
+        args.profile,
+        args.profile_dir,
+        args.code_profiler,
     )
@@ -0,0 +1,88 @@
+import hashlib
+import sqlite3
+
+
+def create_deduplicated_schema(cur: sqlite3.Cursor):
+    """Creates the tiles_shallow / tiles_data / tiles view layout used by combine.py and rio merge."""
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS tiles_shallow ("
+        "TILES_COL_Z integer, "
+        "TILES_COL_X integer, "
+        "TILES_COL_Y integer, "
+        "TILES_COL_DATA_ID text "
+        ", primary key(TILES_COL_Z,TILES_COL_X,TILES_COL_Y) "
+        ") without rowid;"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS tiles_data ("
+        "tile_data_id text primary key, "
+        "tile_data blob "
+        ");"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS metadata (name text, value text);"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS tiles AS "
+        "SELECT "
+        "tiles_shallow.TILES_COL_Z AS zoom_level, "
+        "tiles_shallow.TILES_COL_X AS tile_column, "
+        "tiles_shallow.TILES_COL_Y AS tile_row, "
+        "tiles_data.tile_data AS tile_data "
+        "FROM tiles_shallow "
+        "JOIN tiles_data ON tiles_shallow.TILES_COL_DATA_ID = tiles_data.tile_data_id;"
+    )
+
+
+def is_deduplicated(cur: sqlite3.Cursor, schema: str = "main") -> bool:
+    """Returns True if the database uses tiles_shallow/tiles_data instead of a plain tiles table."""
+    cur.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = 'tiles_shallow'")
+    return cur.fetchone() is not None
+
+
+def insert_tiles(cur: sqlite3.Cursor, rows, deduplicated: bool = True):
+    """Inserts (zoom_level, tile_column, tile_row, tile_data) rows, replacing existing tiles.
+
+    In a deduplicated database identical blobs are stored once, keyed by their md5.
+    """
+    if not deduplicated:
+        cur.executemany(
+            "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        return
+
+    shallow = []
+    data = {}
+    for z, x, y, blob in rows:
+        data_id = hashlib.md5(blob).hexdigest()
+        data[data_id] = blob
+        shallow.append((z, x, y, data_id))
+    cur.executemany(
+        "INSERT OR IGNORE INTO tiles_data (tile_data_id, tile_data) VALUES (?, ?)",
+        data.items(),
+    )
+    cur.executemany(
+        "INSERT OR REPLACE INTO tiles_shallow (TILES_COL_Z, TILES_COL_X, TILES_COL_Y, TILES_COL_DATA_ID) VALUES (?, ?, ?, ?)",
+        shallow,
+    )
+
+
+def remove_unused_tile_data(cur: sqlite3.Cursor):
+    cur.execute(
+        "DELETE FROM tiles_data WHERE tile_data_id NOT IN (SELECT DISTINCT TILES_COL_DATA_ID FROM tiles_shallow)"
+    )
+
+
+def read_metadata(mbtiles_path: str) -> dict:
+    conn = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    try:
+        return dict(conn.execute("SELECT name, value FROM metadata").fetchall())
+    finally:
+        conn.close()
+
+
+def write_metadata(cur: sqlite3.Cursor, metadata: dict):
+    for name, value in metadata.items():
+        cur.execute("DELETE FROM metadata WHERE name = ?", (name,))
+        cur.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (name, str(value)))
@@ -0,0 +1,505 @@
+import argparse
+import copy
+import json
+import os
+import sqlite3
+
+import mercantile
+
+from mbtiles_utils import (
+    create_deduplicated_schema,
+    insert_tiles,
+    read_metadata,
+    remove_unused_tile_data,
+    write_metadata,
+)
+
+BATCH_SIZE = 1000
+
+
+def tile_range(bounds, zoom: int):
+    """Returns the (min_col, max_col, min_row, max_row) TMS tile range covering bounds at zoom."""
+    west, south, east, north = bounds
+    n = 2 ** zoom
+    ul = mercantile.tile(max(west, -180.0), min(north, 85.0511287798066), zoom)
+    lr = mercantile.tile(min(east, 180.0) - 1e-9, max(south, -85.0511287798066) + 1e-9, zoom)
+    min_x, max_x = max(ul.x, 0), min(lr.x, n - 1)
+    min_y, max_y = max(ul.y, 0), min(lr.y, n - 1)
+    # MBTiles rows are TMS (flipped y)
+    return min_x, max_x, n - 1 - max_y, n - 1 - min_y
+
+
+def split_groups(groups, shard_count: int) -> list:
+    """Recursively cuts (gx, gy, count) groups into up to shard_count parts of similar weight.
+
+    Every cut is a straight line across the longer side of the groups' bounding
+    box, so the bounding boxes of the resulting parts never overlap.
+    """
+    if shard_count <= 1 or len(groups) <= 1:
+        return [groups]
+    xs = [g[0] for g in groups]
+    ys = [g[1] for g in groups]
+    axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+
+    weights = {}
+    for group in groups:
+        weights[group[axis]] = weights.get(group[axis], 0) + group[2]
+    values = sorted(weights)
+    left_shards = shard_count // 2
+    target = sum(weights.values()) * left_shards / shard_count
+    # Cut after the coordinate whose running weight is closest to the target,
+    # keeping at least one coordinate on each side.
+    filled, best, cut = 0, None, values[0]
+    for value in values[:-1]:
+        filled += weights[value]
+        if best is None or abs(filled - target) < best:
+            best, cut = abs(filled - target), value
+
+    left = [g for g in groups if g[axis] <= cut]
+    right = [g for g in groups if g[axis] > cut]
+    return split_groups(left, left_shards) + split_groups(right, shard_count - left_shards)
+
+
+def source_uri(path: str) -> str:
+    """Read-only URI for a source, so a wrong path fails instead of creating an empty database."""
+    return f"file:{path}?mode=ro"
+
+
+def check_sources(paths):
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(
+            f"MBTiles not found (relative paths are resolved against {os.getcwd()}): {', '.join(missing)}"
+        )
+
+
+def resolve_bounds(config: dict) -> list[float]:
+    if "bounds" in config:
+        return config["bounds"]
+    if "bounds_source" in config:
+        source = config["sources"][config["bounds_source"]]
+        bounds = read_metadata(source["path"]).get("bounds")
+        if bounds:
+            return [float(v) for v in bounds.split(",")]
+        print(f"Warning: {source['path']} has no bounds metadata, planning the whole world")
+    return [-180.0, -85.0511287798066, 180.0, 85.0511287798066]
+
+
+def create_plan_schema(cur: sqlite3.Cursor):
+    cur.execute("DROP TABLE IF EXISTS sources")
+    cur.execute("DROP TABLE IF EXISTS plan")
+    cur.execute("DROP TABLE IF EXISTS shards")
+    cur.execute("DROP TABLE IF EXISTS plan_info")
+    cur.execute(
+        "CREATE TABLE sources (source_idx integer primary key, path text, max_zoom integer, passthrough integer)"
+    )
+    # action is 'copy' (exactly one native source, blob can be copied as is) or
+    # 'merge' (overlap, or the only source has to be overzoomed).
+    cur.execute(
+        "CREATE TABLE plan ("
+        "zoom_level integer, tile_column integer, tile_row integer, "
+        "source_count integer, source_mask integer, copy_source integer, "
+        "action text, shard integer, "
+        "primary key(zoom_level, tile_column, tile_row)"
+        ") without rowid"
+    )
+    cur.execute("CREATE TABLE shards (shard integer primary key, config_path text, output_path text, tile_count integer)")
+    cur.execute("CREATE TABLE plan_info (name text primary key, value text)")
+
+
+def add_coverage(cur: sqlite3.Cursor, source_idx: int, source_max: int, zoom: int, bounds):
+    """Adds one source's footprint at zoom to the coverage table.
+
+    Above the source's own max zoom the footprint is its max-zoom tiles expanded
+    to their descendants, since the merge overzooms that source there.
+    """
+    min_x, max_x, min_y, max_y = tile_range(bounds, zoom)
+    if zoom <= source_max:
+        cur.execute(
+            "INSERT INTO coverage SELECT tile_column, tile_row, ?, 1 FROM src.tiles "
+            "WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+            (source_idx, zoom, min_x, max_x, min_y, max_y),
+        )
+        return
+
+    shift = zoom - source_max
+    n = 2 ** shift
+    cur.execute("DELETE FROM offsets")
+    cur.executemany("INSERT INTO offsets VALUES (?, ?)", ((dx, dy) for dx in range(n) for dy in range(n)))
+    cur.execute(
+        "INSERT INTO coverage SELECT t.tile_column * ? + o.dx AS x, t.tile_row * ? + o.dy AS y, ?, 0 "
+        "FROM src.tiles t CROSS JOIN offsets o "
+        "WHERE t.zoom_level = ? AND t.tile_column BETWEEN ? AND ? AND t.tile_row BETWEEN ? AND ? "
+        "AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+        (n, n, source_idx, source_max,
+         min_x >> shift, max_x >> shift, min_y >> shift, max_y >> shift,
+         min_x, max_x, min_y, max_y),
+    )
+
+
+def assign_shards(cur: sqlite3.Cursor, shard_count: int, shard_zoom: int) -> dict:
+    """Splits the merge tiles into shards.
+
+    Tiles below shard_zoom go to shard 0 (the overview shard). Deeper tiles are
+    grouped by their ancestor at shard_zoom, and the groups are split into
+    shard_count parts of similar size with disjoint bounding boxes, since rio
+    merge renders every tile inside a shard's box.
+
+    Returns:
+        dict: shard number -> list of (col, row) groups at shard_zoom (empty for shard 0).
+    """
+    cur.execute("UPDATE plan SET shard = 0 WHERE action = 'merge' AND zoom_level < ?", (shard_zoom,))
+
+    cur.execute(
+        "SELECT tile_column >> (zoom_level - ?) AS gx, tile_row >> (zoom_level - ?) AS gy, COUNT(*) "
+        "FROM plan WHERE action = 'merge' AND zoom_level >= ? GROUP BY gx, gy",
+        (shard_zoom, shard_zoom, shard_zoom),
+    )
+    groups = cur.fetchall()
+
+    shards = {}
+    cur.execute("DROP TABLE IF EXISTS temp.groups")
+    cur.execute("CREATE TEMP TABLE groups (gx integer, gy integer, shard integer, primary key(gx, gy))")
+    if groups:
+        for shard, part in enumerate(split_groups(groups, shard_count), 1):
+            shards[shard] = [(gx, gy) for gx, gy, _ in part]
+            cur.executemany("INSERT INTO groups VALUES (?, ?, ?)", ((gx, gy, shard) for gx, gy, _ in part))
+
+    cur.execute(
+        "UPDATE plan SET shard = (SELECT g.shard FROM groups g "
+        "WHERE g.gx = plan.tile_column >> (plan.zoom_level - ?) AND g.gy = plan.tile_row >> (plan.zoom_level - ?)) "
+        "WHERE action = 'merge' AND zoom_level >= ?",
+        (shard_zoom, shard_zoom, shard_zoom),
+    )
+    return shards
+
+
+def groups_range(groups) -> tuple[int, int, int, int]:
+    """(min_col, max_col, min_row, max_row) of a set of TMS tiles."""
+    return (
+        min(gx for gx, _ in groups), max(gx for gx, _ in groups),
+        min(gy for _, gy in groups), max(gy for _, gy in groups),
+    )
+
+
+def range_bounds(tiles_range, zoom: int) -> list[float]:
+    """Lon/lat bounds of a TMS tile range, pulled in slightly so tiles just outside are not included."""
+    min_x, max_x, min_y, max_y = tiles_range
+    n = 2 ** zoom
+    upper_left = mercantile.bounds(min_x, n - 1 - max_y, zoom)
+    lower_right = mercantile.bounds(max_x, n - 1 - min_y, zoom)
+    inset = 1e-7
+    return [
+        upper_left.west + inset, lower_right.south + inset,
+        lower_right.east - inset, upper_left.north - inset,
+    ]
+
+
+def plan_merge(config_path: str, plan_path: str, shard_count: int = 1, shard_zoom: int = 6):
+    """Plans a rio merge config so compute is only spent where sources overlap.
+
+    For every zoom up to max_zoom and every tile inside the config bounds, the
+    planner counts how many sources cover the tile. Tiles with exactly one
+    source that has the tile natively are marked 'copy' and later copied as raw
+    blobs, provided a copy looks the same as what rio merge would write: same
+    encoding and format as the output, every mask value equal to output_nodata
+    and no gaussian_blur_sigma. Everything else is marked 'merge' and split into
+    shards, each with its own rio merge config that can run on a different machine.
+
+    Args:
+        config_path (str): Path to the merge JSON config (as used by rio merge).
+        plan_path (str): Path of the plan database to (re)create. Shard configs are written next to it.
+        shard_count (int): Number of geographic shards for tiles at or below shard_zoom.
+        shard_zoom (int): Zoom level whose tiles define the shard groups.
+
+    Returns:
+        bool: False (and no plan is written) if sharding would not save any work.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    check_sources(source["path"] for source in config["sources"])
+
+    bounds = resolve_bounds(config)
+    output_encoding = config.get("output_encoding", "mapbox")
+    output_format = config.get("output_format", "png")
+    output_nodata = config.get("output_nodata")
+    blur = config.get("gaussian_blur_sigma")
+
+    conn = sqlite3.connect(plan_path, uri=True)
+    cur = conn.cursor()
+    create_plan_schema(cur)
+
+    source_max = []
+    for idx, source in enumerate(config["sources"]):
+        source_conn = sqlite3.connect(source_uri(source["path"]), uri=True)
+        (max_z,) = source_conn.execute("SELECT MAX(zoom_level) FROM tiles").fetchone()
+        source_conn.close()
+        metadata = read_metadata(source["path"])
+        # rio merge rewrites masked values to output_nodata and blurs every tile
+        # it renders; a raw copy does neither, which would leave nodata holes
+        # or seams next to merged tiles.
+        mismatches = []
+        if source.get("encoding", "mapbox") != output_encoding:
+            mismatches.append("encoding")
+        if metadata.get("format") != output_format:
+            mismatches.append("format")
+        if any(v != output_nodata for v in source.get("mask_values", [])):
+            mismatches.append("mask_values")
+        if blur:
+            mismatches.append("gaussian_blur_sigma")
+        passthrough = not mismatches
+        if mismatches:
+            print(f"  {source['path']}: not copied as-is, always merged (because of {', '.join(mismatches)})")
+        source_max.append(max_z if max_z is not None else -1)
+        cur.execute("INSERT INTO sources VALUES (?, ?, ?, ?)", (idx, source["path"], source_max[-1], int(passthrough)))
+
+    max_zoom = config.get("max_zoom", max(source_max))
+    print(f"Planning {config_path}: {len(config['sources'])} sources, z0-z{max_zoom}, bounds {bounds}")
+
+    cur.execute("CREATE TEMP TABLE offsets (dx integer, dy integer)")
+    for zoom in range(max_zoom + 1):
+        cur.execute("DROP TABLE IF EXISTS temp.coverage")
+        cur.execute("CREATE TEMP TABLE coverage (x integer, y integer, source_idx integer, native integer)")
+        for idx, source in enumerate(config["sources"]):
+            if source_max[idx] < 0:
+                continue
+            cur.execute("ATTACH DATABASE ? AS src", (source_uri(source["path"]),))
+            add_coverage(cur, idx, source_max[idx], zoom, bounds)
+            conn.commit()
+            cur.execute("DETACH DATABASE src")
+
+        cur.execute(
+            "INSERT INTO plan "
+            "SELECT ?, c.x, c.y, COUNT(*), SUM(1 << c.source_idx), "
+            "CASE WHEN COUNT(*) = 1 AND MAX(c.native) = 1 THEN MAX(c.source_idx) END, "
+            "NULL, NULL FROM coverage c GROUP BY c.x, c.y",
+            (zoom,),
+        )
+        cur.execute(
+            "UPDATE plan SET action = CASE WHEN copy_source IS NOT NULL AND "
+            "(SELECT passthrough FROM sources s WHERE s.source_idx = plan.copy_source) = 1 "
+            "THEN 'copy' ELSE 'merge' END WHERE zoom_level = ?",
+            (zoom,),
+        )
+        cur.execute(
+            "UPDATE plan SET copy_source = NULL WHERE zoom_level = ? AND action = 'merge'", (zoom,)
+        )
+        conn.commit()
+
+        cur.execute(
+            "SELECT COUNT(*), SUM(action = 'copy'), SUM(action = 'merge') FROM plan WHERE zoom_level = ?", (zoom,)
+        )
+        total, copies, merges = cur.fetchone()
+        print(f"  z{zoom}: {total} tiles, {copies or 0} copy, {merges or 0} merge")
+
+    shard_zoom = min(shard_zoom, max_zoom)
+    (total_tiles,) = cur.execute("SELECT COUNT(*) FROM plan").fetchone()
+    shards = assign_shards(cur, max(1, shard_count), shard_zoom)
+
+    # rio merge configs have no minimum zoom and rio merge renders every tile
+    # inside a config's bounds. So shards 1..N also render z0..shard_zoom-1 of
+    # their box (already covered by shard 0) and any 'copy' tiles in it;
+    # assemble only keeps each shard's assigned tiles. Count that work, and
+    # give up if the shards together would render at least as many tiles as a
+    # single plain rio merge.
+    (rendered,) = cur.execute("SELECT COUNT(*) FROM plan WHERE zoom_level < ?", (shard_zoom,)).fetchone()
+    for groups in shards.values():
+        min_x, max_x, min_y, max_y = groups_range(groups)
+        (deep,) = cur.execute(
+            "SELECT COUNT(*) FROM plan WHERE zoom_level >= ? "
+            "AND tile_column >> (zoom_level - ?) BETWEEN ? AND ? AND tile_row >> (zoom_level - ?) BETWEEN ? AND ?",
+            (shard_zoom, shard_zoom, min_x, max_x, shard_zoom, min_y, max_y),
+        ).fetchone()
+        (shallow,) = cur.execute(
+            "SELECT COUNT(*) FROM plan WHERE zoom_level < ? "
+            "AND tile_column BETWEEN ? >> (? - zoom_level) AND ? >> (? - zoom_level) "
+            "AND tile_row BETWEEN ? >> (? - zoom_level) AND ? >> (? - zoom_level)",
+            (shard_zoom, min_x, shard_zoom, max_x, shard_zoom, min_y, shard_zoom, max_y, shard_zoom),
+        ).fetchone()
+        rendered += deep + shallow
+    print(f"Shards would render {rendered} tiles, a single rio merge {total_tiles}")
+    if rendered >= total_tiles:
+        print(f"No benefit: nothing (or too little) can be copied as-is. Run rio merge --config {config_path} instead.")
+        conn.close()
+        os.remove(plan_path)
+        return False
+
+    # Write a rio merge config per shard, restricted to the shard's footprint
+    # and to the sources that actually cover it.
+    plan_dir = os.path.dirname(os.path.abspath(plan_path))
+    plan_name = os.path.splitext(os.path.basename(plan_path))[0]
+    cur.execute("SELECT shard, COUNT(*) FROM plan WHERE action = 'merge' GROUP BY shard")
+    for shard, tile_count in cur.fetchall():
+        cur.execute("SELECT DISTINCT source_mask FROM plan WHERE action = 'merge' AND shard = ?", (shard,))
+        mask = 0
+        for (source_mask,) in cur.fetchall():
+            mask |= source_mask
+
+        shard_config = copy.deepcopy(config)
+        shard_config["sources"] = [s for i, s in enumerate(config["sources"]) if mask & (1 << i)]
+        shard_config.pop("bounds_source", None)
+        if shard == 0:
+            shard_config["bounds"] = bounds
+            shard_config["max_zoom"] = shard_zoom - 1
+        else:
+            group_bounds = range_bounds(groups_range(shards[shard]), shard_zoom)
+            shard_config["bounds"] = [
+                max(group_bounds[0], bounds[0]), max(group_bounds[1], bounds[1]),
+                min(group_bounds[2], bounds[2]), min(group_bounds[3], bounds[3]),
+            ]
+            shard_config["max_zoom"] = max_zoom
+        shard_config["output_path"] = os.path.join(plan_dir, f"{plan_name}_shard{shard:03d}.mbtiles")
+
+        shard_config_path = os.path.join(plan_dir, f"{plan_name}_shard{shard:03d}.json")
+        with open(shard_config_path, "w") as f:
+            json.dump(shard_config, f, indent=4)
+        cur.execute(
+            "INSERT INTO shards VALUES (?, ?, ?, ?)",
+            (shard, shard_config_path, shard_config["output_path"], tile_count),
+        )
+        print(f"  shard {shard}: {tile_count} merge tiles, {len(shard_config['sources'])} sources -> {shard_config_path}")
+
+    cur.executemany(
+        "INSERT INTO plan_info VALUES (?, ?)",
+        [("config", json.dumps(config)), ("bounds", json.dumps(bounds)), ("max_zoom", str(max_zoom))],
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS plan_shard ON plan (shard, action)")
+    conn.commit()
+    conn.close()
+    return True
+
+
+def copy_tiles(cur: sqlite3.Cursor, select_sql: str, params=()) -> int:
+    """Streams (z, x, y, blob) rows from select_sql into the destination in batches."""
+    read_cur = cur.connection.cursor()
+    read_cur.execute(select_sql, params)
+    copied = 0
+    while True:
+        rows = read_cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        insert_tiles(cur, rows)
+        copied += len(rows)
+    return copied
+
+
+def assemble(plan_path: str, destination_path: str):
+    """Builds the final MBTiles from a plan: copied single-source tiles plus each shard's merge output.
+
+    Only the tiles a shard was assigned in the plan are taken from its output, so
+    extra tiles rio merge renders around a shard's edges are ignored. The result
+    is written to destination_path + ".tmp" and only renamed into place if every
+    shard output exists and holds all of its assigned tiles.
+
+    Args:
+        plan_path (str): Path to the plan database written by plan_merge.
+        destination_path (str): Path to the MBTiles file to create (must not exist).
+    """
+    if os.path.exists(destination_path):
+        raise FileExistsError(f"{destination_path} already exists, refusing to add tiles to it")
+    check_sources([plan_path])
+    tmp_path = destination_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path, uri=True)
+    try:
+        cur = conn.cursor()
+        create_deduplicated_schema(cur)
+        cur.execute("ATTACH DATABASE ? AS plan", (source_uri(plan_path),))
+
+        cur.execute("SELECT source_idx, path FROM plan.sources ORDER BY source_idx")
+        sources = cur.fetchall()
+        cur.execute("SELECT shard, output_path, tile_count FROM plan.shards ORDER BY shard")
+        shards = cur.fetchall()
+        check_sources([path for _, path in sources] + [output_path for _, output_path, _ in shards])
+
+        incomplete = []
+        for source_idx, path in sources:
+            cur.execute("ATTACH DATABASE ? AS src", (source_uri(path),))
+            copied = copy_tiles(
+                cur,
+                "SELECT p.zoom_level, p.tile_column, p.tile_row, t.tile_data FROM plan.plan p "
+                "JOIN src.tiles t ON t.zoom_level = p.zoom_level AND t.tile_column = p.tile_column AND t.tile_row = p.tile_row "
+                "WHERE p.action = 'copy' AND p.copy_source = ?",
+                (source_idx,),
+            )
+            (expected,) = cur.execute(
+                "SELECT COUNT(*) FROM plan.plan WHERE action = 'copy' AND copy_source = ?", (source_idx,)
+            ).fetchone()
+            conn.commit()
+            cur.execute("DETACH DATABASE src")
+            print(f"Copied {copied}/{expected} tiles from {path}")
+            if copied < expected:
+                incomplete.append(f"{path}: {copied}/{expected} tiles")
+
+        metadata = {}
+        for shard, output_path, tile_count in shards:
+            cur.execute("ATTACH DATABASE ? AS shard", (source_uri(output_path),))
+            copied = copy_tiles(
+                cur,
+                "SELECT p.zoom_level, p.tile_column, p.tile_row, t.tile_data FROM plan.plan p "
+                "JOIN shard.tiles t ON t.zoom_level = p.zoom_level AND t.tile_column = p.tile_column AND t.tile_row = p.tile_row "
+                "WHERE p.action = 'merge' AND p.shard = ?",
+                (shard,),
+            )
+            if not metadata:
+                cur.execute("SELECT name, value FROM shard.metadata")
+                metadata = dict(cur.fetchall())
+            conn.commit()
+            cur.execute("DETACH DATABASE shard")
+            print(f"Merged {copied}/{tile_count} tiles from shard {shard}")
+            if copied < tile_count:
+                incomplete.append(f"shard {shard} ({output_path}): {copied}/{tile_count} tiles")
+
+        if incomplete:
+            raise RuntimeError("Incomplete inputs, not assembling: " + "; ".join(incomplete))
+
+        cur.execute("SELECT name, value FROM plan.plan_info")
+        info = dict(cur.fetchall())
+        bounds = json.loads(info["bounds"])
+        metadata.update({
+            "bounds": ",".join(str(v) for v in bounds),
+            "minzoom": 0,
+            "maxzoom": info["max_zoom"],
+        })
+        cur.execute("DELETE FROM metadata")
+        write_metadata(cur, metadata)
+        conn.commit()
+        cur.execute("DETACH DATABASE plan")
+
+        remove_unused_tile_data(cur)
+        conn.commit()
+    except BaseException:
+        conn.close()
+        os.remove(tmp_path)
+        raise
+    conn.close()
+    os.replace(tmp_path, destination_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plan a rio merge so only overlapping tiles are merged, then assemble the result.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan", help="Compute the per-zoom copy/merge plan and write shard configs.")
+    plan_parser.add_argument("config", help="Path to the merge JSON config (e.g. merge/merge_europe.json).")
+    plan_parser.add_argument("plan", help="Path to the plan database to create.")
+    plan_parser.add_argument("-n", "--shards", type=int, default=1, help="Number of geographic shards for the merge work.")
+    plan_parser.add_argument("--shard-zoom", type=int, default=6, help="Zoom level used to group tiles into shards.")
+
+    assemble_parser = subparsers.add_parser("assemble", help="Combine copied tiles and shard outputs into one MBTiles.")
+    assemble_parser.add_argument("plan", help="Path to the plan database.")
+    assemble_parser.add_argument("destination", help="Path to the destination MBTiles file.")
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "plan":
+            if not plan_merge(args.config, args.plan, args.shards, args.shard_zoom):
+                raise SystemExit(1)
+        else:
+            assemble(args.plan, args.destination)
+            print(f"Assembled merge into: {args.destination}")
+    except (FileNotFoundError, FileExistsError, RuntimeError) as e:
+        raise SystemExit(f"Error: {e}")
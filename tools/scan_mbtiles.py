@@ -0,0 +1,344 @@
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import sqlite3
+
+import numpy as np
+from PIL import Image
+
+from mbtiles_utils import read_metadata
+from terrain_codec import decode_elevation
+
+BATCH_SIZE = 256
+HASH_MODULUS = 1000003
+
+MAGIC = {
+    "png": lambda data: data[:8] == b"\x89PNG\r\n\x1a\n",
+    "webp": lambda data: data[:4] == b"RIFF" and data[8:12] == b"WEBP",
+    "jpg": lambda data: data[:3] == b"\xff\xd8\xff",
+}
+
+
+def detect_format(data: bytes) -> str:
+    for name, matches in MAGIC.items():
+        if matches(data):
+            return name
+    return "unknown"
+
+
+def create_report_schema(cur: sqlite3.Cursor):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS scan_tiles ("
+        "zoom_level integer, tile_column integer, tile_row integer, "
+        "data_hash text, size_bytes integer, format text, width integer, height integer, "
+        "nodata_fraction real, min_elev real, max_elev real, outlier_count integer, issues text, "
+        "primary key(zoom_level, tile_column, tile_row)"
+        ") without rowid"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS scan_summary ("
+        "zoom_level integer primary key, tiles_scanned integer, bad_tiles integer, empty_tiles integer, "
+        "outlier_tiles integer, mean_nodata_fraction real, min_elev real, max_elev real"
+        ")"
+    )
+    cur.execute("CREATE TABLE IF NOT EXISTS scan_info (name text primary key, value text)")
+
+
+def check_tile(data: bytes, settings: dict) -> dict:
+    """Decodes one tile and runs the integrity and quality checks on it."""
+    result = {
+        "size_bytes": len(data),
+        "format": detect_format(data),
+        "width": None,
+        "height": None,
+        "nodata_fraction": None,
+        "min_elev": None,
+        "max_elev": None,
+        "outlier_count": None,
+    }
+    issues = []
+    if settings["format"] and result["format"] != settings["format"]:
+        issues.append("format_mismatch")
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except Exception:
+        result["issues"] = ",".join(issues + ["decode_error"])
+        return result
+
+    result["width"], result["height"] = img.size
+    if img.size != (settings["tile_size"], settings["tile_size"]):
+        issues.append("bad_size")
+    if img.mode not in ("RGB", "RGBA"):
+        issues.append("bad_mode")
+
+    elevations = decode_elevation(
+        np.asarray(img.convert("RGB")), settings["encoding"], interval=settings["interval"], base_val=settings["base_val"]
+    )
+    nodata = np.zeros(elevations.shape, dtype=bool)
+    for nodata_val in settings["nodata_values"]:
+        nodata |= np.isclose(elevations, nodata_val, rtol=0, atol=1e-3)
+    result["nodata_fraction"] = float(nodata.mean())
+
+    valid = elevations[~nodata]
+    if valid.size:
+        result["min_elev"] = float(valid.min())
+        result["max_elev"] = float(valid.max())
+        outliers = int(np.count_nonzero((valid < settings["min_elev"]) | (valid > settings["max_elev"])))
+        result["outlier_count"] = outliers
+        if outliers:
+            issues.append("outliers")
+    else:
+        result["outlier_count"] = 0
+        issues.append("empty")
+
+    result["issues"] = ",".join(issues)
+    return result
+
+
+def scan_tiles(mbtiles_path: str, tiles, previous_hashes: dict, settings: dict):
+    """Scans a batch of (z, x, y) tiles, skipping those whose blob hash matches the last report.
+
+    Returns:
+        tuple: (rows for scan_tiles, number of unchanged tiles skipped)
+    """
+    conn = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    rows = []
+    unchanged = 0
+    try:
+        for z, x, y in tiles:
+            cursor.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, y)
+            )
+            found = cursor.fetchone()
+            if found is None or found[0] is None:
+                rows.append((z, x, y, None, 0, None, None, None, None, None, None, None, "missing_data"))
+                continue
+            data = found[0]
+            data_hash = hashlib.md5(data).hexdigest()
+            if previous_hashes.get((z, x, y)) == data_hash:
+                unchanged += 1
+                continue
+            r = check_tile(data, settings)
+            rows.append((
+                z, x, y, data_hash, r["size_bytes"], r["format"], r["width"], r["height"],
+                r["nodata_fraction"], r["min_elev"], r["max_elev"], r["outlier_count"], r["issues"],
+            ))
+    finally:
+        conn.close()
+    return rows, unchanged
+
+
+def select_tiles(cur: sqlite3.Cursor, zoom: int, sample: float, min_per_zoom: int):
+    """Returns a cursor over the tiles to scan at zoom.
+
+    With sample < 1 a deterministic, spatially spread subset is chosen from a
+    hash of the tile coordinates, so repeated runs revisit the same tiles.
+    Zoom levels with at most min_per_zoom tiles are always scanned completely.
+    """
+    (count,) = cur.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level = ?", (zoom,)).fetchone()
+    if sample >= 1.0 or count <= min_per_zoom:
+        cur.execute("SELECT zoom_level, tile_column, tile_row FROM tiles WHERE zoom_level = ?", (zoom,))
+        return cur, count
+    fraction = max(sample, min_per_zoom / count)
+    threshold = int(fraction * HASH_MODULUS)
+    cur.execute(
+        "SELECT zoom_level, tile_column, tile_row FROM tiles WHERE zoom_level = ? "
+        "AND (tile_column * 73856093 + tile_row * 19349663) % ? < ?",
+        (zoom, HASH_MODULUS, threshold),
+    )
+    return cur, int(count * fraction)
+
+
+def update_summary(cur: sqlite3.Cursor):
+    cur.execute("DELETE FROM scan_summary")
+    cur.execute(
+        "INSERT INTO scan_summary SELECT zoom_level, COUNT(*), "
+        "SUM(issues LIKE '%decode_error%' OR issues LIKE '%bad_size%' OR issues LIKE '%format_mismatch%' "
+        "OR issues LIKE '%bad_mode%' OR issues LIKE '%missing_data%'), "
+        "SUM(issues LIKE '%empty%'), SUM(issues LIKE '%outliers%'), "
+        "AVG(nodata_fraction), MIN(min_elev), MAX(max_elev) "
+        "FROM scan_tiles GROUP BY zoom_level"
+    )
+
+
+def print_summary(cur: sqlite3.Cursor):
+    print(f"{'zoom':>4} {'scanned':>10} {'bad':>8} {'empty':>8} {'outlier':>8} {'nodata%':>8} {'min':>10} {'max':>10}")
+    for z, scanned, bad, empty, outlier, nodata, min_elev, max_elev in cur.execute(
+        "SELECT * FROM scan_summary ORDER BY zoom_level"
+    ).fetchall():
+        nodata_str = f"{nodata * 100:.1f}" if nodata is not None else "-"
+        min_str = f"{min_elev:.1f}" if min_elev is not None else "-"
+        max_str = f"{max_elev:.1f}" if max_elev is not None else "-"
+        print(f"{z:>4} {scanned:>10} {bad or 0:>8} {empty or 0:>8} {outlier or 0:>8} {nodata_str:>8} {min_str:>10} {max_str:>10}")
+
+
+def scan_mbtiles(mbtiles_path: str, report_path: str, encoding: str = 'mapbox', interval: float = 0.1, base_val: float = -10000.0,
+                 nodata_values=None, tile_format: str = None, tile_size: int = 256, min_elev: float = -11000.0,
+                 max_elev: float = 9000.0, sample: float = 1.0, min_per_zoom: int = 100, zooms=None, workers: int = None):
+    """Checks every (or a sample of every zoom's) tile of a TerrainRGB/Terrarium MBTiles.
+
+    Results go to the scan_tiles table of report_path, one row per tile, and a
+    per-zoom scan_summary table. Each row stores the md5 of the tile blob, so
+    re-running against the same report resumes an interrupted scan and only
+    re-checks tiles that changed since the last run.
+
+    Args:
+        mbtiles_path (str): MBTiles file to scan.
+        report_path (str): SQLite report database (created if missing).
+        nodata_values (list[float]): Decoded elevations counted as nodata (e.g. mask_values from a merge config).
+        tile_format (str): Expected tile format (defaults to the 'format' metadata).
+        tile_size (int): Expected tile width and height.
+        min_elev (float): Valid elevations below this are counted as outliers.
+        max_elev (float): Valid elevations above this are counted as outliers.
+        sample (float): Fraction of tiles to scan per zoom (1.0 scans everything).
+        min_per_zoom (int): Minimum number of tiles scanned per zoom when sampling.
+        zooms (list[int]): Only scan these zoom levels.
+        workers (int): Number of worker processes.
+    """
+    metadata = read_metadata(mbtiles_path)
+    if nodata_values is None:
+        nodata_values = [base_val] if encoding == "mapbox" else [-32768.0]
+    settings = {
+        "encoding": encoding,
+        "interval": interval,
+        "base_val": base_val,
+        "nodata_values": list(nodata_values),
+        "format": tile_format or metadata.get("format"),
+        "tile_size": tile_size,
+        "min_elev": min_elev,
+        "max_elev": max_elev,
+    }
+    workers = workers or os.cpu_count() or 8
+
+    report_conn = sqlite3.connect(report_path, uri=True)
+    report_cur = report_conn.cursor()
+    create_report_schema(report_cur)
+    (previous_settings,) = report_cur.execute(
+        "SELECT COALESCE((SELECT value FROM scan_info WHERE name = 'settings'), '')"
+    ).fetchone()
+    if previous_settings and json.loads(previous_settings) != settings:
+        # Stored results were computed with different checks, start over
+        print("Scan settings changed, discarding previous results")
+        report_cur.execute("DELETE FROM scan_tiles")
+    report_cur.execute("INSERT OR REPLACE INTO scan_info VALUES ('settings', ?)", (json.dumps(settings),))
+    report_cur.execute("INSERT OR REPLACE INTO scan_info VALUES ('mbtiles', ?)", (os.path.abspath(mbtiles_path),))
+    report_conn.commit()
+
+    src_conn = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    src_cur = src_conn.cursor()
+    if zooms is None:
+        zooms = [z for (z,) in src_cur.execute("SELECT DISTINCT zoom_level FROM tiles ORDER BY zoom_level").fetchall()]
+
+    print(f"Scanning {mbtiles_path} (z{','.join(str(z) for z in zooms)}), sample {sample:g}, {workers} workers")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for zoom in zooms:
+            tile_cur, expected = select_tiles(src_cur, zoom, sample, min_per_zoom)
+            scanned = unchanged = 0
+            pending = set()
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < workers * 2:
+                    batch = tile_cur.fetchmany(BATCH_SIZE)
+                    if not batch:
+                        exhausted = True
+                        break
+                    previous = {}
+                    for tile in batch:
+                        report_cur.execute(
+                            "SELECT data_hash FROM scan_tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", tile
+                        )
+                        found = report_cur.fetchone()
+                        if found:
+                            previous[tile] = found[0]
+                    pending.add(executor.submit(scan_tiles, mbtiles_path, batch, previous, settings))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    rows, skipped = future.result()
+                    report_cur.executemany(
+                        "INSERT OR REPLACE INTO scan_tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                    )
+                    report_conn.commit()
+                    scanned += len(rows)
+                    unchanged += skipped
+            print(f"  z{zoom}: checked {scanned}, unchanged {unchanged} (of ~{expected} selected)")
+
+    src_conn.close()
+
+    # Drop results for tiles that no longer exist in the MBTiles
+    report_cur.execute("ATTACH DATABASE ? AS src", (f"file:{mbtiles_path}?mode=ro",))
+    report_cur.execute(
+        "DELETE FROM scan_tiles WHERE NOT EXISTS (SELECT 1 FROM src.tiles t WHERE t.zoom_level = scan_tiles.zoom_level "
+        "AND t.tile_column = scan_tiles.tile_column AND t.tile_row = scan_tiles.tile_row)"
+    )
+    report_conn.commit()
+    report_cur.execute("DETACH DATABASE src")
+
+    update_summary(report_cur)
+    report_conn.commit()
+    print_summary(report_cur)
+    report_conn.close()
+
+
+def load_config_settings(config_path: str, source_index: int = None) -> dict:
+    """Takes encoding, nodata and format from a merge config (the output, or one of its sources)."""
+    with open(config_path) as f:
+        config = json.load(f)
+    if source_index is None:
+        settings = {"encoding": config.get("output_encoding", "mapbox"), "tile_format": config.get("output_format")}
+        if "output_nodata" in config:
+            settings["nodata_values"] = [config["output_nodata"]]
+        return settings
+    source = config["sources"][source_index]
+    settings = {"encoding": source.get("encoding", "mapbox")}
+    if "mask_values" in source:
+        settings["nodata_values"] = source["mask_values"]
+    return settings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the tiles of a TerrainRGB/Terrarium MBTiles for decode errors, bad sizes, nodata and outliers.")
+    parser.add_argument("mbtiles_file", help="Path to MBTiles file")
+    parser.add_argument("-r", "--report", default=None, help="Report database (default: <mbtiles>.scan.db). Re-using it resumes and only re-checks changed tiles.")
+    parser.add_argument("-c", "--config", default=None, help="Merge JSON config to take encoding, nodata and format from.")
+    parser.add_argument("--source", type=int, default=None, help="With --config, check against this source's settings instead of the merge output.")
+    parser.add_argument("-e", "--encoding", choices=['terrarium', 'mapbox'], default=None, help="Encoding (default: mapbox)")
+    parser.add_argument("--interval", type=float, default=0.1, help="Mapbox interval")
+    parser.add_argument("--base-val", type=float, default=-10000.0, help="Mapbox base value")
+    parser.add_argument("--nodata", nargs='+', type=float, default=None, help="Decoded elevations counted as nodata.")
+    parser.add_argument("--format", default=None, choices=['png', 'webp', 'jpg'], help="Expected tile format (default: from metadata).")
+    parser.add_argument("--tile-size", type=int, default=256, help="Expected tile width/height.")
+    parser.add_argument("--min-elev", type=float, default=-11000.0, help="Elevations below this are outliers.")
+    parser.add_argument("--max-elev", type=float, default=9000.0, help="Elevations above this are outliers.")
+    parser.add_argument("--sample", type=float, default=1.0, help="Fraction of tiles to check per zoom level.")
+    parser.add_argument("--min-per-zoom", type=int, default=100, help="Minimum tiles checked per zoom level when sampling.")
+    parser.add_argument("-z", "--zoom", nargs='+', type=int, default=None, help="Only check these zoom levels.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    config_settings = load_config_settings(args.config, args.source) if args.config else {}
+
+    scan_mbtiles(
+        args.mbtiles_file,
+        args.report or args.mbtiles_file + ".scan.db",
+        args.encoding or config_settings.get("encoding", "mapbox"),
+        args.interval,
+        args.base_val,
+        args.nodata if args.nodata is not None else config_settings.get("nodata_values"),
+        args.format or config_settings.get("tile_format"),
+        args.tile_size,
+        args.min_elev,
+        args.max_elev,
+        args.sample,
+        args.min_per_zoom,
+        args.zoom,
+        args.workers,
+    )
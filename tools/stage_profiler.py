@@ -0,0 +1,262 @@
+import collections
+import contextlib
+import cProfile
+import json
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+
+
+class StageStats:
+    """Accumulates wall time, call counts and bytes handled per named pipeline stage.
+
+    Args:
+        trace (bool): Also keep one event per stage call for a Chrome/Perfetto trace.
+        labels (dict): Extra fields (e.g. the HGT cell) attached to trace events.
+    """
+
+    def __init__(self, trace: bool = False, **labels):
+        self.totals = collections.defaultdict(lambda: [0, 0.0, 0])  # count, seconds, bytes
+        self.events = [] if trace else None
+        self.labels = labels
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Times the enclosed block. Yields a dict; set its "bytes" to record an allocation/IO size."""
+        info = {"bytes": 0}
+        start = time.perf_counter()
+        start_ns = time.time_ns()
+        try:
+            yield info
+        finally:
+            seconds = time.perf_counter() - start
+            entry = self.totals[name]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += info["bytes"]
+            if self.events is not None:
+                self.events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": start_ns / 1000.0,
+                    "dur": seconds * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": dict(self.labels, bytes=info["bytes"]),
+                })
+
+    def merge(self, other: dict):
+        """Adds the totals (and trace events) of another StageStats.to_dict() result."""
+        for name, (count, seconds, nbytes) in other["totals"].items():
+            entry = self.totals[name]
+            entry[0] += count
+            entry[1] += seconds
+            entry[2] += nbytes
+        if self.events is not None and other.get("events"):
+            self.events.extend(other["events"])
+
+    def to_dict(self) -> dict:
+        return {"totals": {name: list(v) for name, v in self.totals.items()}, "events": self.events}
+
+
+class NullStats:
+    """Stand-in for StageStats when profiling is off; stage() costs one context manager."""
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        yield {"bytes": 0}
+
+
+NULL_STATS = NullStats()
+
+
+def print_stage_table(totals: dict, title: str = "Stage timings"):
+    """Prints count, total/mean time, share of time and bytes for each stage."""
+    grand_total = sum(v[1] for v in totals.values()) or 1.0
+    print(f"{title}:")
+    print(f"  {'stage':<18} {'count':>10} {'total s':>10} {'mean ms':>10} {'share':>7} {'MB':>10}")
+    for name, (count, seconds, nbytes) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        mean_ms = seconds / count * 1000 if count else 0.0
+        print(f"  {name:<18} {count:>10} {seconds:>10.2f} {mean_ms:>10.3f} {seconds / grand_total:>6.1%} {nbytes / 1048576:>10.1f}")
+
+
+def write_trace(path: str, events: list):
+    """Writes events in the Chrome trace format (open with chrome://tracing or ui.perfetto.dev)."""
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+class StackSampler:
+    """Minimal sampling profiler: records the stack of one thread every interval.
+
+    Output is in the "folded" format used by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class CodeProfiler:
+    """Wraps cProfile or StackSampler behind one start/stop/dump interface.
+
+    Args:
+        kind (str): 'cprofile' or 'sample'.
+        output_prefix (str): Path prefix; '.prof' or '.folded' is appended.
+    """
+
+    def __init__(self, kind: str, output_prefix: str):
+        self.kind = kind
+        self.output_prefix = output_prefix
+        self.profiler = cProfile.Profile() if kind == "cprofile" else StackSampler()
+
+    def start(self):
+        if self.kind == "cprofile":
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        if self.kind == "cprofile":
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+
+    def dump(self) -> str:
+        if self.kind == "cprofile":
+            path = self.output_prefix + ".prof"
+            self.profiler.dump_stats(path)
+        else:
+            path = self.output_prefix + ".folded"
+            self.profiler.write(path)
+        return path
+
+
+_worker_profiler = None
+
+
+def start_worker_profiler(kind: str, output_dir: str):
+    """Starts a profiler once per worker process; it is dumped when the worker exits."""
+    global _worker_profiler
+    if _worker_profiler is not None or not kind:
+        return
+    _worker_profiler = CodeProfiler(kind, os.path.join(output_dir, f"worker_{os.getpid()}"))
+    _worker_profiler.start()
+
+    def dump():
+        _worker_profiler.stop()
+        _worker_profiler.dump()
+
+    # multiprocessing runs these finalizers when a pool worker exits normally
+    multiprocessing.util.Finalize(None, dump, exitpriority=10)
+
+
+class PipelineProfile:
+    """Collects stage timings of a worker pool + main-process pipeline and reports them.
+
+    Worker results are grouped per process id, main-process work per output
+    item (e.g. per HGT cell). finish() prints summary tables and, if an output
+    directory was given, writes profile.json, a trace and the code profiles.
+
+    Args:
+        output_dir (str): Directory for machine-readable output (None to only print).
+        code_profiler (str): Optional 'cprofile' or 'sample' profiler for the main process and workers (needs output_dir).
+    """
+
+    def __init__(self, output_dir: str = None, code_profiler: str = None):
+        if code_profiler and not output_dir:
+            raise ValueError("code_profiler needs an output_dir to write the profiles to")
+        self.output_dir = output_dir
+        self.code_profiler = code_profiler
+        self.trace = output_dir is not None
+        self.worker_stats = {}
+        self.item_stats = {}
+        self.phases = {}
+        self.events = [] if self.trace else None
+        self.main_profiler = None
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        if self.code_profiler:
+            self.main_profiler = CodeProfiler(self.code_profiler, os.path.join(output_dir, "main"))
+            self.main_profiler.start()
+
+    def add_worker_result(self, pid: int, stats: dict):
+        self.worker_stats.setdefault(pid, StageStats()).merge({"totals": stats["totals"]})
+        if self.events is not None and stats.get("events"):
+            self.events.extend(stats["events"])
+
+    def item(self, name: str) -> StageStats:
+        """Returns a StageStats for one main-process item; it is stored under name."""
+        stats = StageStats(trace=self.trace, item=name)
+        self.item_stats[name] = stats
+        return stats
+
+    @staticmethod
+    def _combined(stats_list) -> dict:
+        combined = StageStats()
+        for stats in stats_list:
+            combined.merge({"totals": stats.to_dict()["totals"]})
+        return combined.to_dict()["totals"]
+
+    def finish(self):
+        if self.main_profiler:
+            self.main_profiler.stop()
+
+        worker_totals = self._combined(self.worker_stats.values())
+        item_totals = self._combined(self.item_stats.values())
+        print("Wall time per phase:")
+        for name, seconds in self.phases.items():
+            print(f"  {name:<18} {seconds:>10.2f} s")
+        if worker_totals:
+            print_stage_table(worker_totals, f"Worker stages (summed over {len(self.worker_stats)} workers)")
+        if item_totals:
+            print_stage_table(item_totals, f"Main process stages ({len(self.item_stats)} items)")
+
+        if not self.output_dir:
+            return
+        report = {
+            "phases": self.phases,
+            "worker_stages": worker_totals,
+            "workers": {str(pid): s.to_dict()["totals"] for pid, s in self.worker_stats.items()},
+            "main_stages": item_totals,
+            "items": {name: s.to_dict()["totals"] for name, s in self.item_stats.items()},
+        }
+        with open(os.path.join(self.output_dir, "profile.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        events = list(self.events)
+        for stats in self.item_stats.values():
+            events.extend(stats.events or [])
+        write_trace(os.path.join(self.output_dir, "trace.json"), events)
+        if self.main_profiler:
+            self.main_profiler.dump()
+        print(f"Profile written to: {self.output_dir}")
@@ -0,0 +1,61 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+RESAMPLING = {
+    'nearest': Image.Resampling.NEAREST,
+    'bilinear': Image.Resampling.BILINEAR,
+    'cubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+    'average': Image.Resampling.BOX,
+}
+
+# Elevation written for pixels without data (both encode to RGB 0,0,0 with the default settings)
+DEFAULT_NODATA = {'mapbox': -10000.0, 'terrarium': -32768.0}
+
+
+def decode_elevation(pixels: np.ndarray, encoding: str, interval: float = 0.1, base_val: float = -10000.0) -> np.ndarray:
+    """Decodes an (H, W, 3+) RGB array into float64 elevations."""
+    data = pixels[..., :3].astype(np.float64)
+    if encoding == "terrarium":
+        return (data[..., 0] * 256.0 + data[..., 1] + data[..., 2] / 256.0) - 32768.0
+    else: # 'mapbox' encoding
+        return base_val + (((data[..., 0] * 256.0 * 256.0) + (data[..., 1] * 256.0) + data[..., 2]) * interval)
+
+
+def encode_elevation(elevations: np.ndarray, encoding: str, interval: float = 0.1, base_val: float = -10000.0) -> np.ndarray:
+    """Encodes float elevations into an (H, W, 3) uint8 RGB array (inverse of decode_elevation)."""
+    rgb = np.empty(elevations.shape + (3,), dtype=np.uint8)
+    if encoding == "terrarium":
+        value = np.clip(elevations + 32768.0, 0, 65535.996)
+        whole = np.floor(value)
+        rgb[..., 0] = whole // 256
+        rgb[..., 1] = whole % 256
+        rgb[..., 2] = np.floor((value - whole) * 256.0)
+    else: # 'mapbox' encoding
+        value = np.clip(np.rint((elevations - base_val) / interval), 0, 256 ** 3 - 1).astype(np.int64)
+        rgb[..., 0] = (value >> 16) & 0xFF
+        rgb[..., 1] = (value >> 8) & 0xFF
+        rgb[..., 2] = value & 0xFF
+    return rgb
+
+
+def decode_tile(tile_data: bytes, encoding: str, interval: float = 0.1, base_val: float = -10000.0) -> np.ndarray:
+    img = Image.open(io.BytesIO(tile_data)).convert("RGB")
+    return decode_elevation(np.asarray(img), encoding, interval=interval, base_val=base_val)
+
+
+def image_to_bytes(pixels: np.ndarray, tile_format: str) -> bytes:
+    """Encodes an RGB/RGBA uint8 array as png or (lossless) webp."""
+    buf = io.BytesIO()
+    img = Image.fromarray(pixels)
+    if tile_format == "webp":
+        img.save(buf, format="WEBP", lossless=True)
+    else:
+        img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def encode_tile(elevations: np.ndarray, encoding: str, tile_format: str, interval: float = 0.1, base_val: float = -10000.0) -> bytes:
+    return image_to_bytes(encode_elevation(elevations, encoding, interval=interval, base_val=base_val), tile_format)